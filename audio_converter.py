@@ -1,9 +1,35 @@
 import shlex
 import subprocess
 
-from discord import FFmpegAudio
+from discord import FFmpegAudio, FFmpegOpusAudio
 from discord.opus import Encoder as OpusEncoder
 
+try:
+    import audioop  # Removed in Python 3.13
+except ImportError:
+    audioop = None
+
+SILENCE_THRESHOLD = 16  # Highest sample value (of 32767) that still counts as silence
+SILENCE_TAIL = 5  # Silent frames still sent before going quiet, so the decoder doesn't interpolate into the gap
+
+
+def is_silent(frame):
+    if audioop is not None:
+        return audioop.max(frame, 2) <= SILENCE_THRESHOLD
+    # Digital silence only, every sample is 0, -1, 255 or -256
+    return not frame.translate(None, b"\x00\xff")
+
+
+def speaking_updater(player):
+    # Callback for FFmpegSpotifyAudio.on_speaking. Resuming also restarts the player's frame clock, otherwise the
+    # frames after a gap would be sent without pacing to catch up with the time spent waiting.
+    def on_speaking(speaking):
+        if speaking:
+            player.resume()
+        else:
+            player._speak(False)
+    return on_speaking
+
 
 class FFmpegSpotifyAudio(FFmpegAudio):
     """An audio source from FFmpeg (or AVConv).
@@ -41,12 +67,17 @@ class FFmpegSpotifyAudio(FFmpegAudio):
     """
 
     def __init__(self, source, link_code, *, executable='ffmpeg', pipe=False,
-                 stderr=None, before_options=None, options=None):
+                 stderr=None, before_options=None, options=None, silence_gate=False):
         args = []
         subprocess_kwargs = {'stdin': source if pipe else subprocess.DEVNULL, 'stderr': stderr}
 
         self.link_code = link_code
 
+        # With the silence gate, read() holds back frames during silence, so nothing is encoded or sent.
+        self.silence_gate = silence_gate
+        self.silent_frames = 0
+        self.on_speaking = None  # Called with False when the gate closes and with True when it opens again
+
         if isinstance(before_options, str):
             args.extend(shlex.split(before_options))
 
@@ -62,10 +93,62 @@ class FFmpegSpotifyAudio(FFmpegAudio):
         super().__init__(source, executable=executable, args=args, **subprocess_kwargs)
 
     def read(self):
-        ret = self._stdout.read(OpusEncoder.FRAME_SIZE)
-        if len(ret) != OpusEncoder.FRAME_SIZE:
-            return b''
-        return ret
+        while True:
+            if self._stdout is None:
+                return b''  # Process was cleaned up, the session is being stopped.
+            ret = self._stdout.read(OpusEncoder.FRAME_SIZE)
+            if len(ret) != OpusEncoder.FRAME_SIZE:
+                return b''
+            if not self.silence_gate or not is_silent(ret):
+                if self.silent_frames > SILENCE_TAIL and self.on_speaking is not None:
+                    self.on_speaking(True)
+                self.silent_frames = 0
+                return ret
+
+            self.silent_frames += 1
+            if self.silent_frames <= SILENCE_TAIL:
+                return ret
+            if self.silent_frames == SILENCE_TAIL + 1 and self.on_speaking is not None:
+                self.on_speaking(False)
+            # Keep reading, ffmpeg's output paces this loop while the gate is closed
 
     def is_opus(self):
         return False
+
+
+class FFmpegSpotifyOpusAudio(FFmpegOpusAudio):
+    """An Opus audio source from FFmpeg, reading the raw PCM stream of the Spoofy client.
+
+    Unlike :class:`FFmpegSpotifyAudio`, FFmpeg does both the resampling and the Opus encoding,
+    so the bot process only forwards the encoded packets to Discord.
+
+    Parameters
+    ------------
+    source: Union[:class:`str`, :class:`io.BufferedIOBase`]
+        The input that ffmpeg will take and convert to Opus packets.
+        If ``pipe`` is ``True`` then this is a file-like object that is
+        passed to the stdin of ffmpeg.
+    bitrate: :class:`int`
+        The bitrate in kbps to encode the output to. Defaults to ``128``.
+    executable: :class:`str`
+        The executable name (and path) to use. Defaults to ``ffmpeg``.
+    pipe: :class:`bool`
+        If ``True``, denotes that ``source`` parameter will be passed
+        to the stdin of ffmpeg. Defaults to ``False``.
+    stderr: Optional[:term:`py:file object`]
+        A file-like object to pass to the Popen constructor.
+        Could also be an instance of ``subprocess.PIPE``.
+
+    Raises
+    --------
+    ClientException
+        The subprocess failed to be created.
+    """
+
+    def __init__(self, source, link_code, *, bitrate=128, executable='ffmpeg', pipe=False, stderr=None):
+        self.link_code = link_code
+
+        # Flush an ogg page for every packet, by default ffmpeg buffers up to a second of audio per page.
+        super().__init__(source, bitrate=bitrate, codec='libopus', executable=executable, pipe=pipe, stderr=stderr,
+                         before_options='-f s16le -ar 44100 -ac 2',
+                         options='-application audio -page_duration 20000 -flush_packets 1')
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Timings:
+    """The most recent durations of named operations, to keep an eye on request latency."""
+
+    def __init__(self, samples=200):
+        self.samples = samples
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=self.samples)
+            durations.append(seconds)
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        # name -> (count, p50, p95, max) in milliseconds
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self._durations.items()}
+        return {name: (len(values), values[len(values) // 2] * 1000, values[int(len(values) * 0.95)] * 1000,
+                       values[-1] * 1000)
+                for name, values in durations.items() if len(values) > 0}
+
+
+timings = Timings()
+
+
+def get_voice_client(client, voice_channel_id):
+    # Channels and the voice client of a guild are both dict lookups in discord.py, so this doesn't scan all voice
+    # clients. Only call this on the event loop.
+    channel = client.get_channel(voice_channel_id)
+    if channel is None or channel.guild is None:
+        return None
+    voice_client = channel.guild.voice_client
+    if voice_client is None or voice_client.channel is None or voice_client.channel.id != voice_channel_id:
+        return None
+    return voice_client
+
+
+class DiscordBridge:
+    """
+    Runs coroutines on the discord event loop for other threads (the web app), discord.py objects are not thread
+    safe and should only be touched from the loop.
+    """
+
+    def __init__(self, client, timeout=10):
+        self.client = client
+        self.timeout = timeout
+
+    def submit(self, coro):
+        # Returns a concurrent.futures.Future right away, so the calling thread can do other work in the meantime.
+        return asyncio.run_coroutine_threadsafe(coro, self.client.loop)
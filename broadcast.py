@@ -0,0 +1,117 @@
+import threading
+from collections import deque
+
+from discord import AudioSource, ClientException
+from discord.opus import Encoder as OpusEncoder
+
+from audio_converter import speaking_updater
+from log import get_logger
+
+log = get_logger("audio")
+
+BUFFER_PACKETS = 50  # ~ 1 second of 20 ms packets kept for subscribers that are a bit behind
+
+
+class BroadcastSource:
+    """
+    Reads and Opus-encodes the audio of one source once, for any number of voice clients. Every voice client plays a
+    subscriber with its own position in a shared buffer of packets. There is no extra thread: the subscriber that is
+    furthest ahead reads the next packet from the source, the others find it in the buffer.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.encoder = None if source.is_opus() else OpusEncoder()
+        self.packets = deque(maxlen=BUFFER_PACKETS)
+        self.head = 0  # Position of the next packet read from the source
+        self.ended = False
+        self.subscribers = []
+        self._lock = threading.Lock()  # For the buffer and the subscribers, never held while reading the source
+        self._read_lock = threading.Lock()  # Only one subscriber reads from the source at a time
+
+        # The silence gate of the source blocks while it is silent, all subscribers have to know about it
+        if getattr(source, "silence_gate", False):
+            source.on_speaking = self.on_speaking
+
+    def subscribe(self):
+        with self._lock:
+            subscriber = BroadcastSubscriber(self, self.head)
+            self.subscribers.append(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def on_speaking(self, speaking):
+        # Called from inside source.read(), with the read lock held.
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if subscriber.on_speaking is not None:
+                subscriber.on_speaking(speaking)
+
+    def read(self, position):
+        # Returns the packet at a position and the position after it, b'' once the source ended. Subscribers that are
+        # behind get their packet from the buffer, without waiting for a read from the source.
+        with self._lock:
+            if position < self.head or self.ended:
+                return self.get_packet(position)
+        with self._read_lock:
+            # Another subscriber may have read the packet while this one was waiting
+            with self._lock:
+                should_read = position >= self.head and not self.ended
+            if should_read:
+                data = self.source.read()
+                if data and self.encoder is not None:
+                    data = self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+                with self._lock:
+                    if not data:
+                        self.ended = True
+                    else:
+                        self.packets.append(data)
+                        self.head += 1
+        with self._lock:
+            return self.get_packet(position)
+
+    def get_packet(self, position):
+        # With the lock held.
+        if position >= self.head:
+            return b'', position
+        # A subscriber that fell out of the buffer skips ahead to the oldest packet
+        oldest = self.head - len(self.packets)
+        position = max(position, oldest)
+        return self.packets[position - oldest], position + 1
+
+
+class BroadcastSubscriber(AudioSource):
+    """What a voice client plays to receive a broadcast, already Opus encoded."""
+
+    def __init__(self, broadcast, position):
+        self.broadcast = broadcast
+        self.position = position
+        self.on_speaking = None  # See audio_converter.speaking_updater
+
+    def read(self):
+        data, self.position = self.broadcast.read(self.position)
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.broadcast.unsubscribe(self)
+
+
+def play_broadcast(voice_client, broadcast):
+    # Raises discord.ClientException if the voice client is already playing something.
+    subscriber = broadcast.subscribe()
+    try:
+        voice_client.play(subscriber, after=lambda x: log.error("Player error: %s", x) if x else None)
+    except ClientException:
+        subscriber.cleanup()
+        raise
+    # noinspection PyProtectedMember
+    subscriber.on_speaking = speaking_updater(voice_client._player)
+
@@ -0,0 +1,239 @@
+"""
+Control protocol between the Spoofy client app and the bot, spoken on the session's ingest port.
+
+A client opts in by starting the connection with MAGIC and a version byte, anything else is treated as the old raw
+PCM stream. After that both sides send frames: a 1 byte frame type and a 4 byte (big endian) payload length, followed
+by the payload. JSON payloads are utf-8 encoded objects.
+
+    HELLO    client -> bot  {"link_code", "user", "resume_token" (optional), "start" (optional), "udp" (optional)}
+    WELCOME  bot -> client  {"resume_token", "resumed", "format", "sample_rate", "channels", "keepalive"}, and
+                            {"udp_token", "udp_port", "frame_size"} if the audio can be sent over UDP
+    ERROR    bot -> client  {"msg"}, the bot closes the connection after sending it
+    PING     both ways, any payload, answered with a PONG with the same payload
+    PONG     both ways
+    AUDIO    client -> bot  raw s16le audio
+    EVENT    both ways      {"event", ...}, player state from the client ("track" with "track_id", "seek", "pause",
+                            "play", "stop", optionally with "position_ms") or the result of a start from the bot
+    CONTROL  bot -> client  {"action", ...}: "throttle" / "unthrottle" (backpressure), "disconnect"
+
+The client can send audio right after HELLO without waiting for WELCOME, so a session is set up in one round trip.
+Sending "start": true in HELLO does what a call to /start/ does. A client that reconnects with the resume_token of its
+last WELCOME continues the same session, without starting playback again. With "udp": true the audio is sent as
+datagrams instead of AUDIO frames, see udp_ingest.py.
+"""
+import json
+import select
+import struct
+import threading
+import time
+
+from drift import BYTES_PER_SECOND
+from udp_ingest import UdpIngest, FLUSH_TIMEOUT, FRAME_SIZE
+
+MAGIC = b"SPFY"
+VERSION = 1
+HEADER = struct.Struct("!BI")
+MAX_PAYLOAD = 1 << 20
+
+HELLO, WELCOME, ERROR, PING, PONG, AUDIO, EVENT, CONTROL = range(1, 9)
+
+HELLO_TIMEOUT = 10  # seconds
+KEEPALIVE_INTERVAL = 10  # seconds without frames before the bot sends a ping
+KEEPALIVE_TIMEOUT = 30  # seconds without frames before the bot gives up on the client
+SEND_TIMEOUT = 5  # seconds, a client that doesn't read its frames can't block the bot
+
+# Ask the client to hold back audio when the backlog is this far towards the latency at which audio gets dropped, and
+# to continue when it drained.
+THROTTLE_HIGH = 0.75
+THROTTLE_LOW = 0.4
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload=b""):
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def decode_json(payload):
+    try:
+        obj = json.loads(payload.decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError(f"Invalid JSON payload - {e}")
+    if not isinstance(obj, dict):
+        raise ProtocolError("JSON payload is not an object")
+    return obj
+
+
+class FrameReader:
+    """Splits the bytes received from a connection into frames."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            frame_type, length = HEADER.unpack_from(self.buffer)
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"Frame of {length} bytes is too large")
+            if len(self.buffer) < HEADER.size + length:
+                break
+            frames.append((frame_type, bytes(self.buffer[HEADER.size:HEADER.size + length])))
+            del self.buffer[:HEADER.size + length]
+        return frames
+
+
+class ControlConnection:
+    """Sending side of a control connection, frames can be sent from any thread."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def send(self, frame_type, payload=b""):
+        with self._lock:
+            self.connection.sendall(encode_frame(frame_type, payload))
+
+    def send_json(self, frame_type, obj):
+        self.send(frame_type, json.dumps(obj).encode("utf-8"))
+
+
+def is_control_client(connection, wakeup):
+    # Reads the first bytes of a new connection. Returns whether the client speaks the control protocol, or None if
+    # the wakeup pipe fired, the client left or it didn't send the magic within HELLO_TIMEOUT. Also returns the bytes
+    # that were read, for a raw client they are the start of its audio.
+    received = b""
+    deadline = time.monotonic() + HELLO_TIMEOUT
+    while len(received) < len(MAGIC) + 1:
+        readable, _, _ = select.select([connection, wakeup], [], [], max(deadline - time.monotonic(), 0))
+        if wakeup in readable or len(readable) == 0:
+            return None, received
+        data = connection.recv(len(MAGIC) + 1 - len(received))
+        if len(data) == 0:
+            return None, received
+        received += data
+        if not MAGIC.startswith(received[:len(MAGIC)]):
+            return False, received
+    if received[-1] != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {received[-1]}")
+    return True, b""
+
+
+def handle_hello(controller, control, payload):
+    # Returns whether the session was resumed, and the UdpIngest for the audio if the client sends it over UDP.
+    hello = decode_json(payload)
+    if hello.get("link_code") != controller.link_code:
+        control.send_json(ERROR, {"msg": "Invalid link code."})
+        raise ProtocolError("Invalid link code")
+    if hello.get("user") is not None:
+        controller.set_username(hello["user"])
+
+    resumed = hello.get("resume_token") == controller.resume_token
+    welcome = {"resume_token": controller.resume_token, "resumed": resumed, "format": "s16le", "sample_rate": 44100,
+               "channels": 2, "keepalive": KEEPALIVE_INTERVAL}
+    udp_socket = controller.get_udp_socket() if hello.get("udp") else None
+    udp = UdpIngest(udp_socket) if udp_socket is not None else None
+    if udp is not None:
+        welcome.update({"udp_token": udp.token.hex(), "udp_port": controller.port, "frame_size": FRAME_SIZE})
+    control.send_json(WELCOME, welcome)
+
+    # Switching the Spotify device takes a few requests, keep receiving audio in the meantime.
+    if hello.get("start") and not resumed and controller.start_handler is not None:
+        def start():
+            result = controller.start_handler(controller)
+            try:
+                control.send_json(EVENT, {"event": "start", **result})
+            except OSError:
+                pass  # Client is gone already
+        threading.Thread(target=start, daemon=True).start()
+    return resumed, udp
+
+
+def serve(controller, connection, output_io, wakeup):
+    """
+    Handles a control connection until the client leaves. Returns True if the wakeup pipe fired, so the listener
+    should stop.
+    """
+    connection.settimeout(SEND_TIMEOUT)
+    control = ControlConnection(connection)
+    reader = FrameReader()
+    udp = None
+    has_hello = throttled = False
+    last_received = last_ping = time.monotonic()
+    compensator = controller.new_drift_compensator()
+    throttle_high = compensator.max_latency * THROTTLE_HIGH * BYTES_PER_SECOND
+    throttle_low = compensator.max_latency * THROTTLE_LOW * BYTES_PER_SECOND
+
+    def write_audio(data, now):
+        nonlocal throttled
+        backlog = controller.get_audio_backlog(connection)
+        if not throttled and backlog > throttle_high:
+            control.send_json(CONTROL, {"action": "throttle"})
+            throttled = True
+        elif throttled and backlog < throttle_low:
+            control.send_json(CONTROL, {"action": "unthrottle"})
+            throttled = False
+        compensator.write(output_io, data, backlog, now)
+        controller.last_audio_at = now
+
+    controller.control = control
+    try:
+        while True:
+            waiting = [connection, wakeup] + ([udp.sock] if udp is not None else [])
+            # Frames held back by the jitter buffer are released when the stream stalls
+            timeout = FLUSH_TIMEOUT if udp is not None and udp.is_waiting() else KEEPALIVE_INTERVAL
+            readable, _, _ = select.select(waiting, [], [], timeout)
+            if wakeup in readable:
+                return True
+            now = time.monotonic()
+
+            if udp is not None:
+                released = udp.receive(now) if udp.sock in readable else udp.poll(now)
+                if len(released) > 0:
+                    write_audio(b"".join(released), now)
+
+            # UDP audio keeps the select busy, so the keepalive can't wait for a timeout
+            if now - last_received > KEEPALIVE_TIMEOUT:
+                controller.log.warning("Client timed out")
+                return False
+            if now - max(last_received, last_ping) >= KEEPALIVE_INTERVAL:
+                control.send(PING, struct.pack("!d", now))
+                last_ping = now
+            if connection not in readable:
+                continue
+
+            data = connection.recv(65536)
+            if len(data) == 0:
+                controller.log.info("Client has disconnected")
+                return False
+            last_received = now
+
+            for frame_type, payload in reader.feed(data):
+                if not has_hello:
+                    if frame_type != HELLO:
+                        raise ProtocolError(f"Expected HELLO, got frame type {frame_type}")
+                    has_hello = True
+                    resumed, udp = handle_hello(controller, control, payload)
+                    if resumed:
+                        controller.log.info("Client resumed its session")
+                elif frame_type == AUDIO:
+                    write_audio(payload, now)
+                elif frame_type == PING:
+                    control.send(PONG, payload)
+                elif frame_type == EVENT:
+                    controller.on_client_event(decode_json(payload))
+                elif frame_type == PONG:
+                    pass
+                else:
+                    raise ProtocolError(f"Unexpected frame type {frame_type}")
+    except ProtocolError as e:
+        controller.log.warning("Closing control connection - %s", e)
+        return False
+    finally:
+        controller.control = None
+        controller.log.info("Clock drift: %s", compensator.summary())
+        if udp is not None:
+            controller.log.info("UDP audio: %s", udp.summary())
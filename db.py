@@ -1,7 +1,16 @@
 import sqlite3
+import time
+from datetime import datetime
 
-from security import EncryptionTool
-from utils import load_config
+from utils import load_config, get_encryption_tool
+
+_encryption_tool = None
+# Discord uids with a linked spotify account -> time.monotonic() they were last seen linked in the db. Loaded on first
+# use and kept in sync by the functions below.
+_linked_uids = None
+# Seconds a cached linked account is trusted. Other worker processes can unlink it (s!unlink runs on the shard that
+# gets the DMs), this process only notices in the db.
+LINKED_CACHE_TTL = 60
 
 
 def select(query, params):
@@ -36,6 +45,13 @@ delete = insert
 update = insert
 
 
+def encryption_tool():
+    global _encryption_tool
+    if _encryption_tool is None:
+        _encryption_tool = get_encryption_tool(load_config())
+    return _encryption_tool
+
+
 def get_setting(key):
     return select("SELECT value FROM meta WHERE key=?;", (key, ))[0][0]
 
@@ -65,12 +81,18 @@ def add_token(nick, uid, token, valid_until, avatar_url):
 
 
 def get_token_info(token):
+    # Tokens use the same (naive utcnow) timestamps as the link command that created them
+    now = datetime.utcnow().timestamp()
     results = select("SELECT discord_nick, discord_uid, valid_until, avatar_url "
-                     "FROM link_tokens WHERE token=?", (token, ))
+                     "FROM link_tokens WHERE token=? AND valid_until>=?", (token, now))
     return results[0] if len(results) else None
 
 
-def is_linked(uid):
+def purge_expired_tokens():
+    return delete("DELETE FROM link_tokens WHERE valid_until<?", (datetime.utcnow().timestamp(), ))
+
+
+def _is_linked_db(uid):
     return len(select(
         "SELECT discord_uid FROM spotify_details "
         "WHERE discord_uid=? AND username IS NOT NULL AND oauth_refresh IS NOT NULL",
@@ -78,6 +100,30 @@ def is_linked(uid):
     )) != 0
 
 
+def _get_linked_uids():
+    global _linked_uids
+    if _linked_uids is None:
+        now = time.monotonic()
+        _linked_uids = {str(row[0]): now for row in select(
+            "SELECT discord_uid FROM spotify_details WHERE username IS NOT NULL AND oauth_refresh IS NOT NULL", ()
+        )}
+    return _linked_uids
+
+
+def is_linked(uid):
+    linked_uids = _get_linked_uids()
+    checked_at = linked_uids.get(str(uid))
+    if checked_at is not None and time.monotonic() - checked_at < LINKED_CACHE_TTL:
+        return True
+    # Accounts can be linked and unlinked by other processes (the web app, other workers), so check misses and old
+    # hits in the db.
+    if _is_linked_db(uid):
+        linked_uids[str(uid)] = time.monotonic()
+        return True
+    linked_uids.pop(str(uid), None)
+    return False
+
+
 def is_linked_spotify(username):
     return len(select(
         "SELECT discord_uid FROM spotify_details "
@@ -93,22 +139,23 @@ def has_spotify_details(uid):
 def add_or_update_spotify_details(uid, username):
     if has_spotify_details(uid):
         # Update details
-        return update(
+        update(
             "UPDATE spotify_details SET username=? WHERE discord_uid=?;",
             (username, uid)
         )
     else:
         # Insert new details
-        return insert(
+        insert(
             "INSERT INTO spotify_details (discord_uid, username) VALUES (?, ?);",
             (uid, username)
         )
+    # The oauth callback saves the token first, so this completes the link
+    if _linked_uids is not None and _is_linked_db(uid):
+        _linked_uids[str(uid)] = time.monotonic()
 
 
 def add_or_update_spotify_token_info(uid, token_info):
-    config = load_config()
-    e = EncryptionTool(config['encryption_key_passphrase'].encode("utf-8"))
-    encrypted_token_info = e.encrypt(token_info)
+    encrypted_token_info = encryption_tool().encrypt(token_info)
 
     if has_spotify_details(uid):
         # Update details
@@ -126,17 +173,16 @@ def add_or_update_spotify_token_info(uid, token_info):
 
 
 def get_spotify_token_info(uid):
-    config = load_config()
-    e = EncryptionTool(config['encryption_key_passphrase'].encode("utf-8"))
-
     results = select("SELECT oauth_refresh FROM spotify_details WHERE discord_uid=?", (uid, ))
     encrypted_token_info = results[0][0] if len(results) else None
     if encrypted_token_info is not None:
-        return e.decrypt(encrypted_token_info)
+        return encryption_tool().decrypt(encrypted_token_info)
     return None
 
 
 def remove_spotify_details(uid):
+    if _linked_uids is not None:
+        _linked_uids.pop(str(uid), None)
     return delete("DELETE FROM spotify_details WHERE discord_uid=?", (uid, ))
 
 
@@ -146,3 +192,55 @@ def get_spotify_username(uid):
     if details is not None:
         return details[0]
     return None
+
+
+def save_session(voice_channel_id, link_code, port, discord_uid, playlist_id, device_id, worker_id):
+    return insert(
+        "INSERT OR REPLACE INTO sessions "
+        "(voice_channel_id, link_code, port, discord_uid, playlist_id, device_id, worker_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?);",
+        (voice_channel_id, link_code, port, discord_uid, playlist_id, device_id, worker_id)
+    )
+
+
+def remove_session(voice_channel_id):
+    return delete("DELETE FROM sessions WHERE voice_channel_id=?", (voice_channel_id, ))
+
+
+def get_sessions(worker_id):
+    return select("SELECT voice_channel_id, link_code, port, discord_uid, playlist_id, device_id "
+                  "FROM sessions WHERE worker_id=?", (worker_id, ))
+
+
+def get_session_by_link_code(link_code):
+    results = select("SELECT port, worker_id FROM sessions WHERE link_code=?", (link_code, ))
+    return results[0] if len(results) else None
+
+
+def get_cached_metadata(uri, now):
+    results = select("SELECT data FROM metadata_cache WHERE uri=? AND expires_at>?", (uri, now))
+    return results[0][0] if len(results) else None
+
+
+def save_cached_metadata(uri, data, expires_at):
+    return insert("INSERT OR REPLACE INTO metadata_cache (uri, data, expires_at) VALUES (?, ?, ?);",
+                  (uri, data, expires_at))
+
+
+def purge_cached_metadata(now):
+    return delete("DELETE FROM metadata_cache WHERE expires_at<=?", (now, ))
+
+
+def get_playlist_account_uids():
+    return [uid.strip() for uid in get_setting("playlist_account_uids").split(",") if uid.strip() != ""]
+
+
+def get_playlist_assignment(voice_channel_id):
+    results = select("SELECT account_uid FROM playlist_assignments WHERE voice_channel_id=?", (voice_channel_id, ))
+    return results[0][0] if len(results) else None
+
+
+def save_playlist_assignment(voice_channel_id, account_uid):
+    return insert("INSERT OR REPLACE INTO playlist_assignments (voice_channel_id, account_uid) VALUES (?, ?);",
+                  (voice_channel_id, account_uid))
+
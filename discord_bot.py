@@ -1,52 +1,77 @@
 import asyncio
 import re
-import sys
-import textwrap
 import uuid
 from datetime import datetime, timedelta
 
 import discord
 from discord import Embed
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import CommandNotFound
 from discord.opus import OpusNotLoaded
 from spotipy import SpotifyException
 
-from db import add_token, get_setting, is_linked, remove_tokens, remove_spotify_details
-from spotify_control import SpotifyController
+from broadcast import play_broadcast
+from bridge import get_voice_client, timings
+from db import add_token, get_setting, is_linked, remove_tokens, remove_spotify_details, get_sessions, remove_session, \
+    purge_expired_tokens
+from log import get_logger
+from now_playing import NowPlayingWatcher, now_playing_embed
+from queue_view import QueueView, PREV_PAGE, NEXT_PAGE, REFRESH
+from search import SearchBackend, CandidateStore
+from spotify_control import SpotifyController, SpotifyAuthManger
+import utils
 from utils import init_spotify
 
+log = get_logger("bot")
 
 SPOTIFY_LINK_REGEX = re.compile(r"http(s)?://open\.spotify\.com/(?P<type>[a-zA-Z]+)/(?P<id>[0-9a-zA-Z]+)")
 SPOTIFY_URI_REGEX = re.compile(r"spotify:(?P<type>[a-zA-Z]+):(?P<id>[0-9a-zA-Z]+)")
 
+INVALID_ITEM_MESSAGES = {
+    "track": "Cannot add! Invalid track!",
+    "album": "Cannot add! Invalid album!",
+    "playlist": "Cannot add! Invalid or private playlist!",
+}
 
-async def spotify_cmd_err(bot_config, ctx):
-    if ctx.guild is None:
-        await ctx.reply("This command can only be used in a server, not in DMs.")
-        raise commands.CommandError("Invoker not in a guild.")
 
-    if ctx.voice_client is None or ctx.voice_client.channel is None:
-        await ctx.reply(f"I am not in a voice channel, invite me first with `{bot_config['prefix']}join`.")
-        raise commands.CommandError("Bot not connected to a voice channel.")
+def voice_command(require_linked=False, require_bot_voice=True, require_controller=True):
+    """
+    Checks shared by all voice commands. The controller of the bot's voice channel is looked up once and stored as
+    ctx.controller, so commands don't have to find it again.
+    """
+    async def predicate(ctx):
+        prefix = ctx.cog.bot_config['prefix']
+        if ctx.guild is None:
+            await ctx.reply("This command can only be used in a server, not in DMs.")
+            raise commands.CommandError("Invoker not in a guild.")
+
+        if require_linked and not is_linked(ctx.author.id):
+            await ctx.reply(f"You don't have a Spotify account linked. Please link one using `{prefix}link`.")
+            raise commands.CommandError("User has no spotify account linked.")
+
+        bot_channel = ctx.voice_client.channel if ctx.voice_client is not None else None
+        if require_bot_voice and bot_channel is None:
+            await ctx.reply(f"I am not in a voice channel, invite me first with `{prefix}join`.")
+            raise commands.CommandError("Bot not connected to a voice channel.")
 
-    if ctx.author.voice is None or ctx.author.voice.channel is None:
-        await ctx.reply("You need to be in a voice channel to use this command.")
-        raise commands.CommandError("Invoker not connected to a voice channel.")
+        if ctx.author.voice is None or ctx.author.voice.channel is None:
+            await ctx.reply("You need to be in a voice channel to use this command.")
+            raise commands.CommandError("Invoker not connected to a voice channel.")
 
-    if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-        await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-        raise commands.CommandError("Invoker not in same voice channel as bot.")
+        if bot_channel is not None and ctx.author.voice.channel != bot_channel:
+            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
+            raise commands.CommandError("Invoker not in same voice channel as bot.")
 
-    if ctx.voice_client is not None and ctx.voice_client.channel is not None:
-        controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-        if controller is None:
-            await ctx.reply(f"I'm not playing anything at the moment.")
+        ctx.controller = SpotifyController.get_instance(bot_channel.id) if bot_channel is not None else None
+        if require_controller and ctx.controller is None:
+            await ctx.reply("I'm not playing anything at the moment.")
             raise commands.CommandError("Bot not connected to active spotify session.")
-    else:
-        await ctx.reply(f"I am not in a voice channel, invite me first with `{bot_config['prefix']}join`.")
-        raise commands.CommandError("Bot not connected to a voice channel.")
-    return controller
+
+        # Commands keep an idle session alive
+        if ctx.controller is not None:
+            ctx.controller.touch()
+        return True
+    return commands.check(predicate)
 
 
 class SpoofyBot(commands.Cog):
@@ -54,29 +79,171 @@ class SpoofyBot(commands.Cog):
         super(SpoofyBot, self).__init__(*args, **kwargs)
         self.client = client
         self.bot_config = config
+        self.sessions_restored = False
+        self.search_backend = SearchBackend(ttl=config['search_cache_ttl'], limit=config['search_results'])
+        self.search_candidates = CandidateStore(timeout=config['search_pick_timeout'])
+        self.queue_views = {}  # voice channel id -> QueueView
+        self.now_playing_watchers = {}  # voice channel id -> NowPlayingWatcher
+        self.relays = {}  # voice channel id of a relay -> voice channel id of the session it plays
+        self.idle_reaper.change_interval(seconds=config['idle_check_interval'])
+        self.idle_reaper.start()
+        self.token_purger.start()
+
+    def cog_unload(self):
+        self.idle_reaper.cancel()
+        self.token_purger.cancel()
+
+    def forget_session(self, voice_channel_id):
+        # Drop the live messages of a stopped session
+        self.queue_views.pop(voice_channel_id, None)
+        watcher = self.now_playing_watchers.pop(voice_channel_id, None)
+        if watcher is not None:
+            watcher.stop()
+
+        # Relays of the session have nothing to play anymore
+        self.relays.pop(voice_channel_id, None)
+        for relay_channel_id, session_channel_id in list(self.relays.items()):
+            if session_channel_id == voice_channel_id:
+                del self.relays[relay_channel_id]
+                voice_client = get_voice_client(self.client, relay_channel_id)
+                if voice_client is not None:
+                    asyncio.ensure_future(voice_client.disconnect())
+
+    async def stop_session(self, voice_channel_id):
+        # Stopping the controller joins its audio thread, so don't do it on the event loop.
+        await self.client.loop.run_in_executor(None, SpotifyController.stop_for_channel, voice_channel_id)
+        self.forget_session(voice_channel_id)
+        voice_client = get_voice_client(self.client, voice_channel_id)
+        if voice_client is not None:
+            await voice_client.disconnect()
+
+    async def restore_session(self, voice_channel_id, link_code, port, discord_uid, playlist_id, device_id):
+        session_log = log.bind(channel=voice_channel_id)
+        channel = self.client.get_channel(voice_channel_id)
+        if channel is None:
+            session_log.warning("Not restoring session, channel not found.")
+            remove_session(voice_channel_id)
+            return
+
+        try:
+            voice_client = await channel.connect(reconnect=False)
+        except (asyncio.TimeoutError, discord.ClientException, OpusNotLoaded) as e:
+            session_log.warning("Could not rejoin channel - %r", e)
+            remove_session(voice_channel_id)
+            return
+
+        try:
+            try:
+                controller = SpotifyController.create(channel.id, channel.bitrate, discord_uid, link_code=link_code,
+                                                      port=port, playlist_id=playlist_id, device_id=device_id)
+            except OSError:
+                # Old port is taken, the client app will pick up the new one when it reconnects.
+                controller = SpotifyController.create(channel.id, channel.bitrate, discord_uid, link_code=link_code,
+                                                      playlist_id=playlist_id, device_id=device_id)
+        except (ValueError, IndexError, OSError) as e:
+            session_log.warning("Could not restore session - %s", e)
+            remove_session(voice_channel_id)
+            await voice_client.disconnect()
+            return
+
+        try:
+            await self.client.loop.run_in_executor(None, controller.warm)
+        except SpotifyException as e:
+            controller.log.warning("Could not warm up Spotify clients - %s", e)
+        controller.log.info("Restored session")
+
+    async def restore_sessions(self):
+        sessions = get_sessions(SpotifyController.worker_id)
+        if len(sessions) > 0:
+            log.info("Restoring %s session(s)...", len(sessions))
+            await asyncio.gather(*[self.restore_session(*session) for session in sessions])
+
+    @tasks.loop(seconds=60)
+    async def idle_reaper(self):
+        for controller in list(SpotifyController.get_instances()):
+            reason = controller.get_idle_reason(no_client_timeout=self.bot_config['idle_timeout_no_client'],
+                                                idle_timeout=self.bot_config['idle_timeout_no_audio'],
+                                                empty_channel_timeout=self.bot_config['idle_timeout_empty_channel'])
+            if reason is not None:
+                controller.log.info("Stopping idle session: %s", reason)
+                await self.stop_session(controller.voice_channel_id)
+
+    @idle_reaper.before_loop
+    async def before_idle_reaper(self):
+        await self.client.wait_until_ready()
+
+    @tasks.loop(hours=1)
+    async def token_purger(self):
+        # Link tokens that were never used would otherwise stay in the database forever.
+        await self.client.loop.run_in_executor(None, purge_expired_tokens)
 
     @commands.Cog.listener()
     async def on_connect(self):
-        print("Connected, preparing...", flush=True)
+        log.info("Connected, preparing...")
 
     @commands.Cog.listener()
     async def on_disconnect(self):
-        print("Bot has disconnected from discord.", flush=True)
+        log.warning("Bot has disconnected from discord.")
 
     @commands.Cog.listener()
     async def on_ready(self):
-        print(f"Bot has logged in as {self.client.user} and is ready!", flush=True)
+        log.info("Bot has logged in as %s and is ready!", self.client.user)
+        if not self.sessions_restored:
+            utils.startup_timer.end("discord gateway")
+            log.info(utils.startup_timer.report())
         await self.client.change_presence(activity=discord.CustomActivity(
             name=f"Listening to {self.client.command_prefix}"
         ))
 
+        # on_ready also fires after reconnecting to the gateway, only restore sessions once.
+        if not self.sessions_restored:
+            self.sessions_restored = True
+            await self.restore_sessions()
+
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        print(f"Joined guild {guild} ({guild.id})", flush=True)
+        log.info("Joined guild %s (%s)", guild, guild.id)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
-        print(f"Left guild {guild}.", flush=True)
+        log.info("Left guild %s.", guild)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if before.channel == after.channel:
+            return
+
+        # The bot itself was disconnected or moved, its old session can't be used anymore.
+        if member == self.client.user:
+            if before.channel is not None:
+                await self.client.loop.run_in_executor(None, SpotifyController.stop_for_channel, before.channel.id)
+                self.forget_session(before.channel.id)
+            return
+
+        for channel in (before.channel, after.channel):
+            if channel is None:
+                continue
+            controller = SpotifyController.get_instance(channel.id)
+            if controller is not None:
+                controller.set_channel_empty(all(m.bot for m in channel.members))
+
+    @commands.Cog.listener()
+    async def on_reaction_add(self, reaction, user):
+        # Page through the live queue message
+        if user.bot:
+            return
+        view = discord.utils.find(lambda v: v.message is not None and v.message.id == reaction.message.id,
+                                  self.queue_views.values())
+        if view is None or str(reaction.emoji) not in (PREV_PAGE, NEXT_PAGE, REFRESH):
+            return
+        try:
+            await reaction.remove(user)
+        except discord.HTTPException:
+            pass  # No permission to manage messages, the reaction stays
+        if str(reaction.emoji) == REFRESH:
+            await view.update(reaction.message.channel)
+        else:
+            await view.turn_page(-1 if str(reaction.emoji) == PREV_PAGE else 1)
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
@@ -84,7 +251,34 @@ class SpoofyBot(commands.Cog):
             await ctx.message.add_reaction("❔")
         raise error
 
+    async def get_item_info(self, ctx, controller, item_type, item_id):
+        # Looks up a track, album or playlist for the add command, replies to the user and returns None if we can't.
+        if item_type not in INVALID_ITEM_MESSAGES:
+            await ctx.send(f"Type {item_type} not supported!")
+            return None
+        try:
+            return await self.client.loop.run_in_executor(None, controller.get_item_info, item_type, item_id)
+        except SpotifyException:
+            await ctx.send(INVALID_ITEM_MESSAGES[item_type])
+            return None
+
     # Commands
+    @commands.command()
+    async def stats(self, ctx):
+        """
+        Show some statistics about the bot
+        """
+        cache_stats = SpotifyController.get_metadata_cache_stats()
+        queue_depth = SpotifyController.get_scheduler_queue_depth()
+        await ctx.send(f"Active sessions: {len(SpotifyController.get_instances())} ({len(self.relays)} relays)\n"
+                       f"Queued Spotify requests: {queue_depth['interactive']} interactive, "
+                       f"{queue_depth['bulk']} bulk\n"
+                       f"Metadata cache: {cache_stats['items']} items, "
+                       f"{cache_stats['hit_rate']:.1%} hit rate ({cache_stats['hits']} memory hits, "
+                       f"{cache_stats['db_hits']} database hits, {cache_stats['misses']} misses)"
+                       + "".join(f"\n{name}: {count} calls, p50 {p50:.0f} ms, p95 {p95:.0f} ms, max {slowest:.0f} ms"
+                                 for name, (count, p50, p95, slowest) in timings.summary().items()))
+
     @commands.command()
     async def ping(self, ctx):
         """
@@ -120,6 +314,7 @@ class SpoofyBot(commands.Cog):
         # Remove all link tokens and spotify details for this user
         remove_tokens(ctx.author.id)
         remove_spotify_details(ctx.author.id)
+        SpotifyAuthManger.forget(ctx.author.id)
         await ctx.reply("All your linked accounts were removed, if you had any!")
 
     @commands.command()
@@ -137,7 +332,7 @@ class SpoofyBot(commands.Cog):
             raise commands.CommandError("User has no spotify account linked.")
 
         sp = init_spotify(ctx.author.id)
-        result = sp.me()
+        result = await self.client.loop.run_in_executor(None, sp.me)
         msg_embed = Embed()
         msg_embed.title = "Linked Spotify account"
         msg_embed.url = result['external_urls'].get('spotify', None)
@@ -152,27 +347,11 @@ class SpoofyBot(commands.Cog):
         await ctx.reply(embed=msg_embed)
 
     @commands.command()
+    @voice_command(require_linked=True, require_bot_voice=False, require_controller=False)
     async def join(self, ctx):
         """
         Makes the bot join your voice channel
         """
-        if ctx.guild is None:
-            await ctx.reply("This command can only be used in a server, not in DMs.")
-            raise commands.CommandError("Invoker not in a guild.")
-
-        if not is_linked(ctx.author.id):
-            await ctx.reply(f"You don't have a Spotify account linked. Please link one using "
-                            f"`{self.bot_config['prefix']}link`.")
-            raise commands.CommandError("User has no spotify account linked.")
-
-        if ctx.author.voice is None or ctx.author.voice.channel is None:
-            await ctx.reply("You need to be in a voice channel to use this command.")
-            raise commands.CommandError("Invoker not connected to a voice channel.")
-
-        if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-            raise commands.CommandError("Invoker not in same voice channel as bot.")
-
         # Connect to voice channel that the invoker is in (if we're not already connected somewhere else)
         try:
             controller_instance = await ctx.author.voice.channel.connect(reconnect=False)
@@ -196,7 +375,7 @@ class SpoofyBot(commands.Cog):
                 await ctx.reply(e)
                 return
 
-            controller.get_or_create_playlist()
+            await self.client.loop.run_in_executor(None, controller.get_or_create_playlist)
 
             await ctx.author.send(f"Please enter the following code in your client application and click "
                                   f"'connect' to start playing music!\nCode: `{controller.link_code}`")
@@ -205,61 +384,72 @@ class SpoofyBot(commands.Cog):
                             f"and view the queue with `{self.bot_config['prefix']}queue`")
 
     @commands.command(aliases=['quit'])
+    @voice_command(require_bot_voice=False, require_controller=False)
     async def leave(self, ctx):
         """
         Makes the bot leave your voice channel
         """
-        if ctx.guild is None:
-            await ctx.reply("This command can only be used in a server, not in DMs.")
-            raise commands.CommandError("Invoker not in a guild.")
-
-        if ctx.author.voice is None or ctx.author.voice.channel is None:
-            await ctx.reply("You need to be in a voice channel to use this command.")
-            raise commands.CommandError("Invoker not connected to a voice channel.")
-
-        if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-            raise commands.CommandError("Invoker not in same voice channel as bot.")
-
         if ctx.voice_client is not None:
-            SpotifyController.stop_for_channel(ctx.voice_client.channel.id)
-            await ctx.voice_client.disconnect()
+            await self.stop_session(ctx.voice_client.channel.id)
             return
         await ctx.send('I am not connected to a voice channel...')
 
-    @commands.command(aliases=['a'])
-    async def add(self, ctx, query):
+    @commands.command()
+    @voice_command(require_bot_voice=False, require_controller=False)
+    async def relay(self, ctx, voice_channel_id: int = None):
         """
-        Add a given link, spotify uri or search query to the playlist.
+        Plays your session in your current voice channel too, for example in an overflow room
         """
-        if ctx.guild is None:
-            await ctx.reply("This command can only be used in a server, not in DMs.")
-            raise commands.CommandError("Invoker not in a guild.")
-
-        if ctx.voice_client is None or ctx.voice_client.channel is None:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
-
-        if ctx.author.voice is None or ctx.author.voice.channel is None:
-            await ctx.reply("You need to be in a voice channel to use this command.")
-            raise commands.CommandError("Invoker not connected to a voice channel.")
+        prefix = self.bot_config['prefix']
+        if ctx.voice_client is not None:
+            await ctx.reply("I'm already connected to a voice channel, please disconnect me first!")
+            return
 
-        if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-            raise commands.CommandError("Invoker not in same voice channel as bot.")
+        sessions = [controller for controller in SpotifyController.get_instances()
+                    if str(controller.discord_uid) == str(ctx.author.id)
+                    and (voice_channel_id is None or controller.voice_channel_id == voice_channel_id)]
+        if len(sessions) == 0:
+            await ctx.reply(f"You don't have a session to relay, start one with `{prefix}join` first.")
+            return
+        if len(sessions) > 1:
+            await ctx.reply(f"You have several sessions, pick one with `{prefix}relay <voice channel id>`: "
+                            + ", ".join(str(controller.voice_channel_id) for controller in sessions))
+            return
+        controller = sessions[0]
+        if controller.broadcast is None:
+            await ctx.reply("Your session isn't playing yet, connect your client app first.")
+            return
 
-        if ctx.voice_client is not None and ctx.voice_client.channel is not None:
-            controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-            if controller is None:
-                await ctx.reply("I'm not playing anything at the moment.")
-                raise commands.CommandError("Bot not connected to active spotify session.")
-        else:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
+        # Only the session encodes the audio, the relay plays the same packets.
+        try:
+            voice_client = await ctx.author.voice.channel.connect(reconnect=False)
+        except asyncio.TimeoutError:
+            await ctx.reply("Timeout error while connecting to the voice channel. Please try again later.")
+            return
+        except discord.ClientException:
+            await ctx.reply("I'm already connected to a voice channel, please disconnect me first!")
+            return
+        except OpusNotLoaded:
+            await ctx.reply("Opus library was not loaded. Please try again later.")
+            return
+        try:
+            play_broadcast(voice_client, controller.broadcast)
+        except discord.ClientException:
+            await voice_client.disconnect()
+            await ctx.reply("Could not play the session here, please try again.")
+            return
+        self.relays[voice_client.channel.id] = controller.voice_channel_id
+        await ctx.message.add_reaction("👍")
 
-        print(f"Adding {query} to playlist")
-        controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-        sp = controller.get_playlist_api()
+    @commands.command(aliases=['a'])
+    @voice_command()
+    async def add(self, ctx, *, query):
+        """
+        Add a given link, spotify uri or search query to the playlist.
+        """
+        controller = ctx.controller
+        controller.log.debug("Adding %s to playlist", query)
+        await self.client.loop.run_in_executor(None, controller.get_or_create_playlist)
 
         uri = None
         item_info = None
@@ -271,29 +461,11 @@ class SpoofyBot(commands.Cog):
             if m:
                 uri = f"spotify:{m.group('type')}:{m.group('id')}"
                 item_type = m.group('type')
-                if item_type == "track":
-                    try:
-                        item_info = sp.track(m.group('id'))
-                    except SpotifyException:
-                        await ctx.send("Cannot add! Invalid track!")
-                        return
-                elif item_type == "album":
-                    try:
-                        item_info = sp.album(m.group('id'))
-                    except SpotifyException:
-                        await ctx.send("Cannot add! Invalid album!")
-                        return
-                elif item_type == "playlist":
-                    try:
-                        item_info = sp.playlist(m.group('id'))
-                    except SpotifyException:
-                        await ctx.send("Cannot add! Invalid or private playlist!")
-                        return
-                else:
-                    await ctx.send(f"Type {item_type} not supported!")
+                item_info = await self.get_item_info(ctx, controller, item_type, m.group('id'))
+                if item_info is None:
                     return
 
-                print(f"Converted link to ID '{uri}'")
+                controller.log.debug("Converted link to ID '%s'", uri)
             else:
                 await ctx.send("Only spotify links are supported!")
                 return
@@ -304,70 +476,51 @@ class SpoofyBot(commands.Cog):
             if m:
                 uri = f"spotify:{m.group('type')}:{m.group('id')}"
                 item_type = m.group('type')
-                if item_type == "track":
-                    try:
-                        item_info = sp.track(m.group('id'))
-                    except SpotifyException:
-                        await ctx.send("Cannot add! Invalid track!")
-                        return
-                elif item_type == "album":
-                    try:
-                        item_info = sp.album(m.group('id'))
-                    except SpotifyException:
-                        await ctx.send("Cannot add! Invalid album!")
-                        return
-                elif item_type == "playlist":
-                    try:
-                        item_info = sp.playlist(m.group('id'))
-                    except SpotifyException:
-                        await ctx.send("Cannot add! Invalid or private playlist!")
-                        return
-                else:
-                    await ctx.send(f"Type {item_type} not supported!")
+                item_info = await self.get_item_info(ctx, controller, item_type, m.group('id'))
+                if item_info is None:
                     return
-                print(f"Converted URI to ID '{uri}'")
+                controller.log.debug("Converted URI to ID '%s'", uri)
 
         # Else, try to search
         if uri is None:
-            await ctx.send('Searching not supported yet.')
-            return
+            results = await self.search_backend.search(controller, query)
+            if len(results) == 0:
+                await ctx.send(f"No results found for '{query}'.")
+                return
+            item_type, item_info = "track", results[0]
+            uri = item_info.uri
+
+        await self.add_to_queue(ctx, controller, uri, item_type, item_info)
+
+    async def add_to_queue(self, ctx, controller, uri, item_type, item_info):
+        # Imports can take many API calls, run them in a thread so they don't block other commands.
+        loop = self.client.loop
 
         # Add URI
         if uri is not None:
             if item_type == "track":
-                sp.playlist_add_items(controller.playlist["id"], items=[uri])
+                uris = [uri]
             elif item_type == "album":
-                album_tracks = controller.get_album_tracks(item_info['id'])
-                i, max_tracks = 0, 50
-                while i < len(album_tracks):
-                    block = [t['uri'] for t in album_tracks[i:i+max_tracks]]
-                    sp.playlist_add_items(controller.playlist["id"], items=block)
-                    i += max_tracks
+                album_tracks = await loop.run_in_executor(None, controller.get_album_tracks, item_info['id'])
+                uris = [t.uri for t in album_tracks]
             elif item_type == "playlist":
-                playlist_tracks = controller.get_playlist_tracks(item_info['id'])
-                i, max_tracks = 0, 50
-                while i < len(playlist_tracks):
-                    block = [t['uri'] for t in playlist_tracks[i:i+max_tracks]]
-                    sp.playlist_add_items(controller.playlist["id"], items=block)
-                    i += max_tracks
+                playlist_tracks = await loop.run_in_executor(None, controller.get_playlist_tracks, item_info['id'])
+                uris = [t.uri for t in playlist_tracks]
             else:
                 await ctx.send(f"Cannot add! Type {item_type} not supported!")
                 return
+            await loop.run_in_executor(None, controller.add_to_playlist, uris)
 
             try:
-                controller.update_playlist()
+                await loop.run_in_executor(None, controller.update_playlist)
             except IndexError as e:
-                print(e, file=sys.stderr)
+                controller.log.error("Could not update the playlist - %s", e)
 
             msg_embed = Embed()
             if item_type == "track":
                 full_title = SpotifyController.format_full_title(item_info)
-                try:
-                    thumbnail = item_info['album']['images'][0]['url']
-                except IndexError:
-                    thumbnail = None
-                msg_embed.description = f"Added [{full_title}]({item_info['external_urls']['spotify']}) to queue!"
-                msg_embed.set_thumbnail(url=thumbnail)
+                msg_embed.description = f"Added [{full_title}]({item_info.url}) to queue!"
+                msg_embed.set_thumbnail(url=item_info.image_url)
             elif item_type == "album":
                 full_title = SpotifyController.format_full_title(item_info)
                 try:
@@ -393,223 +546,153 @@ class SpoofyBot(commands.Cog):
                 msg_embed.description = f"Unknown {item_type} item added to queue!"
             await ctx.reply(embed=msg_embed)
 
-    @commands.command()
-    async def clear(self, ctx):
+    @commands.command(aliases=['s'])
+    @voice_command()
+    async def search(self, ctx, *, query):
         """
-        Clear the room playlist
+        Search for a song, and pick one of the results to add to the playlist.
         """
-        if ctx.voice_client is None or ctx.voice_client.channel is None:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
+        controller = ctx.controller
+        results = await self.search_backend.search(controller, query)
+        if len(results) == 0:
+            await ctx.send(f"No results found for '{query}'.")
+            return
+        self.search_candidates.put(controller.voice_channel_id, results)
 
-        if ctx.author.voice is None or ctx.author.voice.channel is None:
-            await ctx.reply("You need to be in a voice channel to use this command.")
-            raise commands.CommandError("Invoker not connected to a voice channel.")
+        lines = [f"{i}) {SpotifyController.format_full_title(track)}" for i, track in enumerate(results, start=1)]
+        await ctx.reply("```\n" + "\n".join(lines) + f"```Add one with `{self.bot_config['prefix']}pick <number>`")
 
-        if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-            raise commands.CommandError("Invoker not in same voice channel as bot.")
+    @commands.command()
+    @voice_command()
+    async def pick(self, ctx, number: int):
+        """
+        Add one of the results of the last search to the playlist.
+        """
+        controller = ctx.controller
+        results = self.search_candidates.get(controller.voice_channel_id)
+        if results is None:
+            await ctx.reply(f"Nothing to pick from, search for something first with "
+                            f"`{self.bot_config['prefix']}search`.")
+            return
+        if not 1 <= number <= len(results):
+            await ctx.reply(f"Pick a number between 1 and {len(results)}.")
+            return
+
+        await self.client.loop.run_in_executor(None, controller.get_or_create_playlist)
+        track = results[number - 1]
+        await self.add_to_queue(ctx, controller, track.uri, "track", track)
 
-        controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-        controller.stop_playlist_playback()
-        controller.clear_playlist()
+    @commands.command()
+    @voice_command()
+    async def clear(self, ctx):
+        """
+        Clear the room playlist
+        """
+        controller = ctx.controller
+        await self.client.loop.run_in_executor(None, controller.stop_playlist_playback)
+        await self.client.loop.run_in_executor(None, controller.clear_playlist)
         await ctx.send("Queue cleared!")
 
     @commands.command(aliases=['q'])
+    @voice_command()
     async def queue(self, ctx):
         """
         Shows the queue
         """
-        if ctx.guild is None:
-            await ctx.reply("This command can only be used in a server, not in DMs.")
-            raise commands.CommandError("Invoker not in a guild.")
-
-        if ctx.voice_client is None or ctx.voice_client.channel is None:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
-
-        if ctx.author.voice is None or ctx.author.voice.channel is None:
-            await ctx.reply("You need to be in a voice channel to use this command.")
-            raise commands.CommandError("Invoker not connected to a voice channel.")
-
-        if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-            raise commands.CommandError("Invoker not in same voice channel as bot.")
-
-        if ctx.voice_client is not None and ctx.voice_client.channel is not None:
-            controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-            if controller is None:
-                await ctx.reply("I'm not playing anything at the moment.")
-                raise commands.CommandError("Bot not connected to active spotify session.")
-        else:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
-
-        controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-        queue, is_playing, current_index, current_progress_ms = controller.get_queue()
-
-        queue_text = ""
-        index_padding = len(str(len(queue)))
-
-        # Current index none and progress not none, means we are playing on the bot, but not playing from the playlist.
-        if current_index is None and current_progress_ms is not None:
-            current_index = -1
-            queue_text += "{-# Currently playing a custom song or playlist. #-}\n"
-            queue_text += f"-- To switch back to room playlist use {self.bot_config['prefix']}start --\n\n"
-
-            sp = controller.get_api()
-            info = sp.current_playback()
-            track = info['item']
-
-            duration_ms = track['duration_ms'] - current_progress_ms
-            duration_s = duration_ms // 1000
-            duration_m, duration_s = divmod(duration_s, 60)
-            duration = f"{duration_m}:{duration_s:02} left"
-            full_title = textwrap.shorten(SpotifyController.format_full_title(track), width=64, placeholder="...")
-            line = f"{full_title} {duration}"
-            queue_text += f"current) {line}\n\n"
-
-        elif current_index is None:
-            current_index = -1
-            if is_playing:
-                queue_text += "{-# Linked spotify account is playing something elsewhere. #-}\n"
-            else:
-                queue_text += "{-# Currently not playing anything. #-}\n"
-            queue_text += f"-- To start playing the room playlist here use {self.bot_config['prefix']}start --\n\n"
-
-
-        min_index = max(current_index - 6, 0)
-        max_index = min(current_index + 11, len(queue))
-        more = len(queue) - max_index
-
-        for i, track in enumerate(queue[min_index:max_index], start=min_index):
-            is_current = i == current_index and is_playing
-            duration_ms = track['duration_ms'] - current_progress_ms if is_current else track['duration_ms']
-            duration_s = duration_ms // 1000
-            duration_m, duration_s = divmod(duration_s, 60)
-            duration = f"{duration_m}:{duration_s:02}{' left' if is_current else ''}"
-            full_title = textwrap.shorten(SpotifyController.format_full_title(track), width=64, placeholder="...")
-            line = f" {(i+1):{index_padding}d}) {full_title} {duration}\n"
-            if is_current:
-                line = f"{' ' * (index_padding + 4)}⬐ current track\n{line}{' ' * (index_padding + 4)}⬑ current track\n"
-            queue_text += line
-
-        if len(queue) == 0:
-            queue_text += "-- Nothing in queue! --\n"
-        else:
-            if more > 0:
-                queue_text += f"\n {' ' * index_padding} -- {more} more track(s) --\n"
-            else:
-                queue_text += f"\n {' ' * index_padding} -- This is the end of the queue! --\n"
-                queue_text += f" {' ' * index_padding} -- Use {self.bot_config['prefix']}add to add more. --\n"
-
-        await ctx.reply(f"```hs\n{queue_text}```")
+        controller = ctx.controller
+        view = self.queue_views.get(controller.voice_channel_id)
+        if view is None or view.controller is not controller:
+            view = QueueView(controller, self.bot_config['prefix'],
+                             edit_interval=self.bot_config['queue_edit_interval'],
+                             reuse_timeout=self.bot_config['queue_message_reuse'])
+            self.queue_views[controller.voice_channel_id] = view
+        await view.show(ctx.channel)
 
     @commands.command(aliases=['np'])
-    async def now_playing(self, ctx):
+    @voice_command()
+    async def now_playing(self, ctx, mode=None):
         """
-        Show the currently playing song
+        Show the currently playing song. Use "np live" for a message that keeps itself up to date, "np stop" to stop it.
         """
-        controller = await spotify_cmd_err(self.bot_config, ctx)
-
-        sp = controller.get_api()
-        info = sp.current_playback()
-        if not controller.is_playing_on_bot():
-            await ctx.send("Not playing anything at the moment...")
+        controller = ctx.controller
+        if mode == "live":
+            watcher = self.now_playing_watchers.pop(controller.voice_channel_id, None)
+            if watcher is not None:
+                watcher.stop()
+            message = await ctx.reply(embed=now_playing_embed(controller.playback.to_playback_info()))
+            watcher = NowPlayingWatcher(controller, message,
+                                        edit_interval=self.bot_config['now_playing_edit_interval'])
+            self.now_playing_watchers[controller.voice_channel_id] = watcher
+            watcher.start()
+            return
+        if mode == "stop":
+            watcher = self.now_playing_watchers.pop(controller.voice_channel_id, None)
+            if watcher is not None:
+                watcher.stop()
+            await ctx.message.add_reaction("👍")
             return
 
-        # Add URI
-        if info is not None:
-            track_info = info['item']
-            try:
-                thumbnail = track_info['album']['images'][0]
-            except IndexError:
-                thumbnail = None
-            msg_embed = Embed()
-            artist_url = track_info['artists'][0]['external_urls']['spotify']
-            msg_embed.set_author(name=SpotifyController.format_artist(track_info), url=artist_url)
-            msg_embed.title = SpotifyController.format_title(track_info)
-            msg_embed.description = f"{SpotifyController.format_album_name(track_info)}\n"
-            msg_embed.url = track_info['external_urls']['spotify']
-            msg_embed.set_thumbnail(url=thumbnail['url'])
-            msg_embed.set_footer(text=f"{SpotifyController.format_progress(info)}")
-            await ctx.reply(embed=msg_embed)
-        else:
+        info = await self.client.loop.run_in_executor(None, controller.get_playback_info)
+        if not controller.is_playing_on_bot(info):
             await ctx.send("Not playing anything at the moment...")
+            return
+        await ctx.reply(embed=now_playing_embed(info))
 
     @commands.command()
+    @voice_command()
     async def pause(self, ctx):
         """
         Pause the currently playing song
         """
-        controller = await spotify_cmd_err(self.bot_config, ctx)
-
+        controller = ctx.controller
+        loop = self.client.loop
         sp = controller.get_api()
-        info = sp.current_playback()
-        if not controller.is_playing_on_bot():
+        info = await loop.run_in_executor(None, controller.get_playback_info)
+        if not controller.is_playing_on_bot(info):
             await ctx.send("Not playing anything at the moment...")
             return
 
         if info is not None:
-            sp.pause_playback()
+            await loop.run_in_executor(None, sp.pause_playback)
+            controller.playback.set_playing(False)
             await ctx.add_reaction("👍")
         else:
             await ctx.send("Not playing anything at the moment...")
 
     @commands.command(aliases=['r'])
+    @voice_command()
     async def resume(self, ctx):
         """
         Resume the currently paused song
         """
-        controller = await spotify_cmd_err(self.bot_config, ctx)
-
+        controller = ctx.controller
+        loop = self.client.loop
         sp = controller.get_api()
-        info = sp.current_playback()
-        if not controller.is_playing_on_bot():
+        info = await loop.run_in_executor(None, controller.get_playback_info)
+        if not controller.is_playing_on_bot(info):
             await ctx.send("Not playing anything at the moment...")
             return
 
         if info is not None:
-            sp.start_playback()
+            await loop.run_in_executor(None, sp.start_playback)
+            controller.playback.set_playing(True)
             await ctx.add_reaction("👍")
         else:
             await ctx.send("Not playing anything at the moment...")
 
     @commands.command()
+    @voice_command()
     async def start(self, ctx):
         """
         Start playing the room playlist
         """
-        if ctx.guild is None:
-            await ctx.reply("This command can only be used in a server, not in DMs.")
-            raise commands.CommandError("Invoker not in a guild.")
-
-        if ctx.voice_client is None or ctx.voice_client.channel is None:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
-
-        if ctx.author.voice is None or ctx.author.voice.channel is None:
-            await ctx.reply("You need to be in a voice channel to use this command.")
-            raise commands.CommandError("Invoker not connected to a voice channel.")
-
-        if ctx.voice_client is not None and ctx.author.voice.channel != ctx.voice_client.channel:
-            await ctx.reply("You need to be in the same voice channel as the bot to use this command.")
-            raise commands.CommandError("Invoker not in same voice channel as bot.")
-
-        if ctx.voice_client is not None and ctx.voice_client.channel is not None:
-            controller = SpotifyController.get_instance(ctx.voice_client.channel.id)
-            if controller is None:
-                await ctx.reply(f"I'm not playing anything at the moment.")
-                raise commands.CommandError("Bot not connected to active spotify session.")
-        else:
-            await ctx.reply(f"I am not in a voice channel, invite me first with `{self.bot_config['prefix']}join`.")
-            raise commands.CommandError("Bot not connected to a voice channel.")
-
-        queue, is_playing, current_index, current_progress_ms = controller.get_queue()
+        controller = ctx.controller
+        loop = self.client.loop
+        queue, is_playing, current_index, current_progress_ms = await loop.run_in_executor(None, controller.get_queue)
 
         if current_index is not None:
             await ctx.reply(f"I'm already playing the room playlist!")
             raise commands.CommandError("Bot not connected to a voice channel.")
 
-        controller.start_playback()
+        await loop.run_in_executor(None, controller.start_playback)
         await ctx.message.add_reaction("👍")
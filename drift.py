@@ -0,0 +1,107 @@
+BYTES_PER_FRAME = 4  # One s16le stereo sample
+BYTES_PER_SECOND = 44100 * BYTES_PER_FRAME
+
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class DriftCompensator:
+    """
+    Keeps the audio waiting between the client and ffmpeg at a target latency. The client sends audio on its own
+    clock, so without correction the backlog slowly grows (more latency) or drains (underruns).
+
+    A PI controller turns the smoothed backlog into a small rate correction, which is applied by repeating or dropping
+    single sample frames spread evenly over the stream. ffmpeg's resampler can't change its rate while running, and at
+    the few hundred ppm of a real clock difference these slips are inaudible. When the backlog is more than
+    max_latency behind (audio that queued up before playback started), whole chunks are dropped until it is back at
+    the target.
+    """
+
+    def __init__(self, target_latency=0.2, max_latency=1.0, max_correction=0.002, gain=0.02, deadband=0.05,
+                 smoothing=5.0):
+        self.target_latency = target_latency
+        self.max_latency = max_latency
+        self.max_correction = max_correction
+        self.gain = gain  # Rate correction per second of latency away from the target
+        self.deadband = deadband  # seconds around the target that are left alone
+        self.smoothing = smoothing  # seconds, time constant of the backlog average
+
+        self.level = None  # Smoothed latency in seconds
+        self.correction = 0.0  # Relative rate change, negative drops frames
+        self.slip = 0.0  # Frames to repeat (or drop, if negative) that didn't add up to a whole frame yet
+        self.remainder = b""
+        self.last_update = None
+        self.draining = False
+        self.repeated = self.dropped = self.dropped_bytes = 0
+
+    def update(self, backlog_bytes, now):
+        latency = backlog_bytes / BYTES_PER_SECOND
+        if self.level is None:
+            self.level, self.last_update = latency, now
+            return
+        dt = now - self.last_update
+        self.last_update = now
+        self.level += min(dt / self.smoothing, 1) * (latency - self.level)
+
+        error = self.level - self.target_latency
+        error -= clamp(error, -self.deadband, self.deadband)
+        self.correction = clamp(-self.gain * error, -self.max_correction, self.max_correction)
+
+    def should_drop(self, backlog_bytes):
+        # Starts dropping above max_latency, and keeps dropping until the backlog is at the target again.
+        latency = backlog_bytes / BYTES_PER_SECOND
+        if latency > self.max_latency:
+            self.draining = True
+        elif self.draining and latency <= self.target_latency:
+            self.draining = False
+            self.level = None  # Start averaging again from the new level
+        return self.draining
+
+    def drop(self, data):
+        self.dropped_bytes += len(data)
+
+    def write(self, output_io, data, backlog_bytes, now):
+        # Corrects and writes a block of received audio. The output is flushed right away, audio held back in the
+        # writer's buffer wouldn't show up in the backlog.
+        self.update(backlog_bytes, now)
+        if self.should_drop(backlog_bytes):
+            self.drop(data)
+            return
+        output_io.write(self.process(data))
+        output_io.flush()
+
+    def summary(self):
+        return (f"repeated {self.repeated} and dropped {self.dropped} frames, skipped "
+                f"{self.dropped_bytes / BYTES_PER_SECOND:.1f} seconds of backlog")
+
+    def process(self, data):
+        data = self.remainder + data
+        usable = len(data) - len(data) % BYTES_PER_FRAME
+        data, self.remainder = data[:usable], data[usable:]
+        frames = usable // BYTES_PER_FRAME
+
+        self.slip += frames * self.correction
+        slips = clamp(int(self.slip), -(frames // 2), frames // 2)
+        if slips == 0:
+            return data
+        self.slip -= slips
+
+        step = frames // (abs(slips) + 1) * BYTES_PER_FRAME
+        parts = []
+        position = 0
+        for i in range(1, abs(slips) + 1):
+            cut = i * step
+            if slips > 0:
+                parts.append(data[position:cut])
+                parts.append(data[cut - BYTES_PER_FRAME:cut])  # Repeat the frame before the cut
+            else:
+                parts.append(data[position:cut - BYTES_PER_FRAME])  # Drop the frame before the cut
+            position = cut
+        parts.append(data[position:])
+        if slips > 0:
+            self.repeated += slips
+        else:
+            self.dropped -= slips
+        return b"".join(parts)
+
@@ -0,0 +1,157 @@
+"""
+Logging for the bot. Records are put on a queue by the thread that logs them, and written to stdout by a background
+thread, so the event loop and the audio threads never wait for the output (journald, a terminal, ...). When the
+writer can't keep up, records are dropped instead.
+
+Loggers from get_logger() add context fields, like the voice channel and port of a session, which are written after
+the message as key=value pairs. Log lines from the same place in the code are rate limited per session, so a noisy
+session doesn't hide the logs of the others.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+QUEUE_SIZE = 10000  # records waiting for the writer, more are dropped
+RATE_LIMIT_INTERVAL = 60  # seconds
+RATE_LIMIT_BURST = 10  # records from the same line of code and session per interval, before the rest is suppressed
+SUPPRESSED_KEEP_INTERVALS = 10  # intervals after which a count of suppressed records is forgotten
+STOP_TIMEOUT = 2  # seconds to wait for queued records to be written when stopping
+
+_listener = None
+
+
+class SessionLogger(logging.LoggerAdapter):
+    """Adds context fields to the records of a logger."""
+
+    def process(self, msg, kwargs):
+        extra = kwargs.get("extra") or {}
+        kwargs["extra"] = {**extra, "context": {**self.extra, **extra.get("context", {})}}
+        return msg, kwargs
+
+    def bind(self, **context):
+        return SessionLogger(self.logger, {**self.extra, **context})
+
+
+def get_logger(name, **context):
+    return SessionLogger(logging.getLogger(f"spoofy.{name}"), context)
+
+
+class ContextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            line += " " + " ".join(f"{key}={value}" for key, value in context.items() if value is not None)
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through burst records per interval from every line of code, counted separately for every context (the
+    session of a SessionLogger). The next record that gets through tells how many were suppressed.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # (file, line, context) -> [window start, records, suppressed]
+        self._pruned_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        context = getattr(record, "context", None) or {}
+        key = (record.pathname, record.lineno, tuple(sorted((name, str(value)) for name, value in context.items())))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._pruned_at >= self.interval:
+                self.prune(now)
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed > 0:
+                    record.context = {**getattr(record, "context", {}), "suppressed": suppressed}
+                return True
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            window[2] += 1
+            return False
+
+    def prune(self, now):
+        # Forgets windows that ended, otherwise every session that ever logged would keep its windows. Windows with
+        # suppressed records are kept longer, for the next record to report them. With the lock held.
+        self._windows = {key: window for key, window in self._windows.items()
+                         if now - window[0] < self.interval * (SUPPRESSED_KEEP_INTERVALS if window[2] else 1)}
+        self._pruned_at = now
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that never blocks, records that don't fit in the queue are counted and dropped."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundWriter(logging.handlers.QueueListener):
+    """Writes the queued records. Stopping gives up after STOP_TIMEOUT when the output is stuck."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel, timeout=STOP_TIMEOUT)
+
+    def stop(self):
+        try:
+            self.enqueue_sentinel()
+        except queue.Full:
+            return
+        self._thread.join(STOP_TIMEOUT)
+        self._thread = None
+
+
+def setup_logging(level="INFO", levels=None, worker_id=None):
+    # Levels can be set per logger as well, for example {"audio": "WARNING"}.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    logger = logging.getLogger("spoofy")
+    logger.setLevel(level)
+    logger.propagate = False
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(f"spoofy.{name}").setLevel(logger_level)
+
+    writer = logging.StreamHandler(sys.stdout)
+    worker = f" [worker {worker_id}]" if worker_id is not None else ""
+    writer.setFormatter(ContextFormatter(f"%(asctime)s %(levelname)s{worker} %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter())
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+
+    _listener = BackgroundWriter(log_queue, writer, respect_handler_level=True)
+    _listener.start()
+    return handler
+
+
+@atexit.register
+def flush_logging():
+    # Writes the records that are still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
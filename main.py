@@ -1,18 +1,22 @@
+import argparse
+import sqlite3
+import subprocess
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from discord.ext import commands
+import utils
+from log import get_logger, setup_logging
 
-from discord_bot import SpoofyBot
+# Heavy imports (discord, spotipy, Flask, cryptography) are done where they're needed, so startup can overlap them.
 
-import utils
-import webapp
-from security import EncryptionTool
+log = get_logger("main")
 
 DEFAULT_CONFIG = {
     "prefix": "s!",
     "bot_token": "INSERT_BOT_TOKEN_HERE",
     "encryption_key_passphrase": "",
+    "encryption_old_key_passphrases": [],
     "spotify_client_id": "",
     "spotify_client_secret": "",
     "spotify_redirect_uri": "https://spoofy.baka.tokyo/callback/",
@@ -21,10 +25,122 @@ DEFAULT_CONFIG = {
     "spotify_scopes_playlist": "playlist-modify-public playlist-read-collaborative",
     "spotify_connect_name": "Spoofy Bot",
     "http_host": "127.0.0.1",
-    "http_port": 5000
+    "http_port": 5000,
+    "worker_http_port": 5100,
+    "audio_encoder": "pcm",
+    "audio_silence_gate": True,
+    "audio_target_latency": 0.2,
+    "audio_max_latency": 1.0,
+    "audio_udp_ingest": True,
+    "metadata_cache_size": 2048,
+    "metadata_cache_sqlite": True,
+    "metadata_cache_ttl": 86400,
+    "metadata_cache_playlist_ttl": 600,
+    "search_cache_ttl": 3600,
+    "search_results": 5,
+    "search_pick_timeout": 120,
+    "queue_edit_interval": 2,
+    "queue_message_reuse": 120,
+    "now_playing_edit_interval": 5,
+    "spotify_app_rate": 10,
+    "spotify_app_burst": 20,
+    "spotify_account_rate": 5,
+    "spotify_account_burst": 10,
+    "spotify_api_workers": 4,
+    "idle_check_interval": 60,
+    "idle_timeout_no_client": 600,
+    "idle_timeout_no_audio": 1800,
+    "idle_timeout_empty_channel": 300,
+    "log_level": "INFO",
+    "log_levels": {}
 }
 
+
+def check_db():
+    import upgrade_db
+    conn = sqlite3.connect("db.sqlite")
+    try:
+        pending = [v for v, _ in upgrade_db.get_migrations() if v > upgrade_db.get_db_version(conn)]
+    finally:
+        conn.close()
+    if len(pending) > 0:
+        log.warning("Database is not up to date, run upgrade_db.py! Missing migrations: %s", pending)
+
+
+def preload_tokens():
+    # Decrypt the tokens of the sessions that will be restored, and of the playlist accounts.
+    from db import get_sessions, get_playlist_account_uids
+    from spotify_control import SpotifyAuthManger, SpotifyController
+    uids = [session[3] for session in get_sessions(SpotifyController.worker_id)] + get_playlist_account_uids()
+    for uid in uids:
+        SpotifyAuthManger.load_token_info(uid)
+
+
+def create_playlist_clients(config):
+    from playlist_accounts import get_linked_playlist_accounts
+    from spotify_control import SpotifyController
+    for account_uid in get_linked_playlist_accounts():
+        SpotifyController.get_playlist_account_api(account_uid, config).auth_manager.get_cached_token()
+
+
+def run_timed(name, func, *args):
+    utils.startup_timer.begin(name)
+    try:
+        func(*args)
+    except Exception as e:
+        log.error("Startup step '%s' failed - %r", name, e)
+    finally:
+        utils.startup_timer.end(name)
+
+
+def warm_up(config):
+    # Runs while the bot connects to discord. Nothing depends on these, they only make the first commands faster.
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="warm-up")
+    executor.submit(run_timed, "database check", check_db)
+    executor.submit(run_timed, "token preload", preload_tokens)
+    executor.submit(run_timed, "playlist account clients", create_playlist_clients, config)
+    executor.shutdown(wait=False)
+
+
+def run_webapp(host, port, client=None):
+    utils.startup_timer.begin("web app import")
+    import webapp
+    utils.startup_timer.end("web app import")
+    if client is not None:
+        from bridge import DiscordBridge
+        from spotify_control import SpotifyController
+        webapp.app.bridge = DiscordBridge(client)
+        SpotifyController.start_handler = staticmethod(webapp.start_session)
+    webapp.app.run(host=host, port=port)
+
+
+def run_coordinator(config, workers):
+    # Every worker runs one discord shard (so a subset of the guilds) together with its audio streams. This process
+    # only serves the public web app, which finds the worker owning a session through the sessions table.
+    processes = [subprocess.Popen([sys.executable, __file__, "--shard-id", str(i), "--shard-count", str(workers)])
+                 for i in range(workers)]
+    log.info("Started %s worker processes", workers)
+    import webapp
+    webapp.app.forward_to_workers = True
+    try:
+        webapp.app.run(host=config['http_host'], port=config['http_port'])
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of bot worker processes to start. Runs everything in one process if 1.")
+    parser.add_argument("--shard-id", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--shard-count", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    setup_logging(worker_id=args.shard_id)
+
+    utils.startup_timer.begin("config")
     try:
         config = utils.load_config()
     except FileNotFoundError:
@@ -35,41 +151,34 @@ if __name__ == '__main__':
     if 'bot_token' not in config.keys() or config['bot_token'] in ["", DEFAULT_CONFIG['bot_token']]:
         config['bot_token'] = DEFAULT_CONFIG['bot_token']
         utils.save_config(config)
-        print("Please configure the bot_token by modifying the 'config.json' file!", flush=True)
+        log.error("Please configure the bot_token by modifying the 'config.json' file!")
         sys.exit(1)
     bot_token = config['bot_token']
 
     # If the encryption key is missing, generate it and save it to the config.
     if 'encryption_key_passphrase' not in config.keys() or config['encryption_key_passphrase'] == "":
-        print(f"Setting up encryption suite for the first time...")
+        log.info("Setting up encryption suite for the first time...")
+        from security import EncryptionTool
         config['encryption_key_passphrase'] = EncryptionTool.generate().decode("utf-8")
         utils.save_config(config)
-    key = config['encryption_key_passphrase'].encode("utf-8")
 
     # Check for other non-existent config keys and initialize them
     save = False
-    if "spotify_client_id" not in config.keys():
-        config["spotify_client_id"] = DEFAULT_CONFIG["spotify_client_id"]
-        save = True
-    if "spotify_client_secret" not in config.keys():
-        config["spotify_client_secret"] = DEFAULT_CONFIG["spotify_client_secret"]
-        save = True
-    if "spotify_redirect_uri" not in config.keys():
-        config["spotify_redirect_uri"] = DEFAULT_CONFIG["spotify_redirect_uri"]
-        save = True
-    if "spotify_scopes" not in config.keys():
-        config["spotify_scopes"] = DEFAULT_CONFIG["spotify_scopes"]
-        save = True
+    for config_key, default_value in DEFAULT_CONFIG.items():
+        if config_key not in config.keys():
+            config[config_key] = default_value
+            save = True
 
     # Save config if necessary
     if save:
         utils.save_config(config)
+    setup_logging(config['log_level'], config['log_levels'], worker_id=args.shard_id)
 
     # Ensure we have a valid encryption suite to use
     try:
-        e = EncryptionTool(key)
-    except EncryptionTool.InvalidKey:
-        print(f"Encryption key is invalid")
+        e = utils.get_encryption_tool(config)
+    except ValueError:
+        log.error("Encryption key is invalid")
         sys.exit(1)
 
     if 'prefix' not in config.keys() or config['prefix'] == "":
@@ -77,17 +186,38 @@ if __name__ == '__main__':
         utils.save_config(config)
 
     prefix = config['prefix']
-    print(f"Bot prefix is '{prefix}'", flush=True)
-
-    webapp_thread = threading.Thread(target=webapp.app.run, kwargs={'host': config['http_host'],
-                                                                    'port': config['http_port']})
-    webapp_thread.start()
+    log.info("Bot prefix is '%s'", prefix)
+    utils.startup_timer.end("config")
+
+    if args.workers > 1:
+        run_coordinator(config, args.workers)
+        sys.exit(0)
+
+    utils.startup_timer.begin("discord import")
+    from discord.ext import commands
+    from discord_bot import SpoofyBot
+    from spotify_control import SpotifyController
+    utils.startup_timer.end("discord import")
+
+    if args.shard_id is not None:
+        # Worker process, only reachable by the coordinator.
+        SpotifyController.worker_id = args.shard_id
+        SpotifyController.port_range = range(15001 + args.shard_id, 16000, args.shard_count)
+        http_host, http_port = "127.0.0.1", config['worker_http_port'] + args.shard_id
+        client = commands.Bot(command_prefix=commands.when_mentioned_or(prefix),
+                              shard_id=args.shard_id, shard_count=args.shard_count)
+        log.info("Running as worker %s/%s", args.shard_id + 1, args.shard_count)
+    else:
+        http_host, http_port = config['http_host'], config['http_port']
+        client = commands.Bot(command_prefix=commands.when_mentioned_or(prefix))
 
-    client = commands.Bot(command_prefix=commands.when_mentioned_or(prefix))
     client.add_cog(SpoofyBot(client=client, config=config))
 
-    webapp.app.discord_bot = client
+    webapp_thread = threading.Thread(target=run_webapp, args=(http_host, http_port, client))
+    webapp_thread.start()
+    warm_up(config)
 
+    utils.startup_timer.begin("discord gateway")
     client.run(bot_token)
 
     webapp_thread.join()
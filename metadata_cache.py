@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_cached_metadata, save_cached_metadata, purge_cached_metadata
+from track import Track
+
+PURGE_EVERY = 256  # Remove expired rows from the SQLite tier every n writes
+
+
+def slim_artists(artists):
+    return [{"name": a["name"], "external_urls": {"spotify": a["external_urls"].get("spotify")}} for a in artists]
+
+
+def slim_images(images):
+    # Only the first (largest) image is ever rendered
+    return [{"url": images[0]["url"]}] if images else []
+
+
+def slim_album(album):
+    return {
+        "id": album["id"],
+        "uri": album["uri"],
+        "name": album["name"],
+        "artists": slim_artists(album["artists"]),
+        "images": slim_images(album["images"]),
+        "external_urls": {"spotify": album["external_urls"].get("spotify")},
+        "tracks": {"total": album["tracks"]["total"]},
+    }
+
+
+def slim_playlist(playlist):
+    return {
+        "id": playlist["id"],
+        "uri": playlist["uri"],
+        "name": playlist["name"],
+        "images": slim_images(playlist["images"]),
+        "external_urls": {"spotify": playlist["external_urls"].get("spotify")},
+        "tracks": {"total": playlist["tracks"]["total"]},
+    }
+
+
+def encode_value(value):
+    # Tracks are stored as dicts, and turned back into Track objects when they are read.
+    if isinstance(value, Track):
+        return value.to_dict()
+    raise TypeError(f"Can't store {type(value).__name__} in the metadata cache")
+
+
+def decode_value(obj):
+    if "duration_ms" in obj and "uri" in obj:
+        return Track.from_dict(obj)
+    return obj
+
+
+class MetadataCache:
+    """Cache for Spotify metadata, keyed by Spotify URI and shared by all controllers.
+
+    Entries are kept in a bounded in-memory LRU, and optionally in the ``metadata_cache`` table so they survive
+    restarts. Only store Track objects and the slimmed down versions of API responses (see ``slim_album`` and friends).
+    """
+
+    def __init__(self, max_items=2048, use_db=True):
+        self.max_items = max_items
+        self.use_db = use_db
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+
+        if self.use_db:
+            data = get_cached_metadata(key, int(now))
+            if data is not None:
+                value = json.loads(data, object_hook=decode_value)
+                # The remaining lifetime is not stored in memory, so just give it a short one.
+                self._remember(key, value, now + 60)
+                self.db_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        self._remember(key, value, expires_at)
+        if self.use_db:
+            save_cached_metadata(key, json.dumps(value, default=encode_value), int(expires_at))
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                purge_cached_metadata(int(time.time()))
+
+    def get_or_fetch(self, key, ttl, fetch):
+        value = self.get(key)
+        if value is None:
+            value = fetch()
+            self.put(key, value, ttl)
+        return value
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            "items": len(self._items),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.db_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import discord
+from discord import Embed
+from spotipy import SpotifyException
+
+from spotify_control import SpotifyController
+
+MID_TRACK_POLL = 30  # seconds between checks while a track plays, progress is extrapolated in between
+END_OF_TRACK_SLACK = 0.5  # seconds after the expected end of a track to check what plays next
+IDLE_POLL = 15  # seconds between checks while nothing plays
+
+
+def now_playing_embed(info):
+    msg_embed = Embed()
+    if info is None or info['item'] is None:
+        msg_embed.description = "Not playing anything at the moment..."
+        return msg_embed
+
+    track = info['item']
+    msg_embed.set_author(name=SpotifyController.format_artist(track), url=track.artist_url or Embed.Empty)
+    msg_embed.title = SpotifyController.format_title(track)
+    if track.album_name is not None:
+        msg_embed.description = f"{SpotifyController.format_album_name(track)}\n"
+    msg_embed.url = track.url or Embed.Empty
+    if track.image_url is not None:
+        msg_embed.set_thumbnail(url=track.image_url)
+    msg_embed.set_footer(text=f"{SpotifyController.format_progress(info)}{'' if info['is_playing'] else ' (paused)'}")
+    return msg_embed
+
+
+def get_check_delay(info):
+    # Rarely check while a track plays, but right after it should have ended.
+    if info is None or info['item'] is None or not info['is_playing']:
+        return IDLE_POLL
+    remaining = (info['item'].duration_ms - info['progress_ms']) / 1000
+    return max(min(remaining + END_OF_TRACK_SLACK, MID_TRACK_POLL), 1)
+
+
+class NowPlayingWatcher:
+    """
+    Keeps a now playing message of a controller up to date. One task per controller checks the playback state and
+    edits the message at most once every edit_interval seconds, only when it changed.
+    """
+
+    def __init__(self, controller, message, edit_interval=5):
+        self.controller = controller
+        self.message = message
+        self.edit_interval = edit_interval
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        next_check = 0
+        next_edit = 0
+        shown = None
+        while SpotifyController.get_instance(self.controller.voice_channel_id) is self.controller:
+            now = time.monotonic()
+            if now >= next_check:
+                try:
+                    info = await loop.run_in_executor(None, self.controller.refresh_playback_info)
+                    next_check = now + get_check_delay(info)
+                except SpotifyException as e:
+                    self.controller.log.warning("Could not check playback for the live now playing message - %s", e)
+                    info, next_check = self.controller.playback.to_playback_info(), now + IDLE_POLL
+            else:
+                info = self.controller.playback.to_playback_info()
+
+            embed = now_playing_embed(info)
+            wake_at = min(time.monotonic() + self.edit_interval, next_check)
+            if embed.to_dict() != shown:
+                if time.monotonic() >= next_edit:
+                    # Failed edits count as well, so a failing message isn't retried more often
+                    next_edit = time.monotonic() + self.edit_interval
+                    try:
+                        await self.message.edit(embed=embed)
+                        shown = embed.to_dict()
+                    except discord.NotFound:
+                        return  # Someone deleted the message
+                    except discord.HTTPException as e:
+                        self.controller.log.warning("Could not update the live now playing message - %s", e)
+                else:
+                    wake_at = min(wake_at, next_edit)
+            await asyncio.sleep(max(wake_at - time.monotonic(), 0))
+
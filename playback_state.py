@@ -0,0 +1,126 @@
+import math
+import threading
+import time
+
+from track import Track
+
+CLIENT_STATE_MAX_AGE = 60  # seconds, poll Spotify at least this often even when the client reports its state
+POLLED_STATE_MAX_AGE = 5  # seconds a polled state is used for clients that don't report their state
+
+
+def get_position_ms(event, default=None):
+    # Raises ValueError if the event has no valid position (and there is no default).
+    position_ms = event.get("position_ms", default)
+    if isinstance(position_ms, bool) or not isinstance(position_ms, (int, float)) or not math.isfinite(position_ms):
+        raise ValueError(f"Invalid position_ms: {position_ms!r}")
+    return max(int(position_ms), 0)
+
+
+class PlaybackState:
+    """
+    What the bot's Spotify player is doing. The client app reports track changes, seeks and pauses as they happen,
+    Spotify is only polled when those reports are missing or when the last poll is too long ago.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.track_id = None
+        self.track = None  # Looked up later for client events, they only carry the track id
+        self.is_playing = False
+        self.progress_ms = 0
+        self.device_name = None
+        self.updated_at = None
+        self.polled_at = None
+        self.client_reports = False
+
+    def get_progress_ms(self, now):
+        # The progress at the last update, plus the time it has been playing since then.
+        progress_ms = self.progress_ms
+        if self.is_playing and self.updated_at is not None:
+            progress_ms += int((now - self.updated_at) * 1000)
+        if self.track is not None:
+            progress_ms = min(progress_ms, self.track.duration_ms)
+        return progress_ms
+
+    def apply_event(self, event, device_name):
+        # Events from the client: "track" (track_id), "seek", "pause", "play" and "stop". Positions are optional,
+        # except for seeks. Returns False for unknown events, raises ValueError for events with invalid fields. Those
+        # don't change the state.
+        kind = event.get("event")
+        with self._lock:
+            now = time.monotonic()
+            if kind == "track":
+                track_id = event.get("track_id")
+                if track_id is not None and not isinstance(track_id, str):
+                    raise ValueError(f"Invalid track_id: {track_id!r}")
+                progress_ms = get_position_ms(event, 0)
+                if track_id != self.track_id:
+                    self.track_id, self.track = track_id, None
+                self.progress_ms = progress_ms
+                self.is_playing = bool(event.get("playing", True))
+            elif kind == "seek":
+                self.progress_ms = get_position_ms(event)
+            elif kind in ("pause", "play"):
+                self.progress_ms = get_position_ms(event, self.get_progress_ms(now))
+                self.is_playing = kind == "play"
+            elif kind == "stop":
+                self.track_id = self.track = None
+                self.progress_ms, self.is_playing = 0, False
+            else:
+                return False
+            self.device_name = device_name
+            self.updated_at = now
+            self.client_reports = True
+            if self.polled_at is None:
+                self.polled_at = now  # Counts as fresh, no need to poll right away
+            return True
+
+    def apply_playback(self, info):
+        # Takes the result of Spotify's current_playback().
+        with self._lock:
+            self.updated_at = self.polled_at = time.monotonic()
+            if info is None or info['item'] is None:
+                self.track_id = self.track = self.device_name = None
+                self.progress_ms, self.is_playing = 0, False
+                return
+            self.track = Track.from_dict(info['item'])
+            self.track_id = self.track.id
+            self.progress_ms = info['progress_ms'] or 0
+            self.is_playing = info['is_playing']
+            self.device_name = info['device']['name']
+
+    def set_track(self, track):
+        with self._lock:
+            if track.id == self.track_id:
+                self.track = track
+
+    def set_playing(self, is_playing):
+        # After the bot paused or resumed playback itself
+        with self._lock:
+            now = time.monotonic()
+            self.progress_ms = self.get_progress_ms(now)
+            self.is_playing = is_playing
+            self.updated_at = now
+
+    def invalidate(self):
+        # After the bot changed what is playing, the next request polls unless the client reports the change first.
+        with self._lock:
+            self.polled_at = None
+
+    def is_fresh(self, client_connected):
+        if self.polled_at is None:
+            return False
+        max_age = CLIENT_STATE_MAX_AGE if self.client_reports and client_connected else POLLED_STATE_MAX_AGE
+        return time.monotonic() - self.polled_at < max_age
+
+    def to_playback_info(self):
+        # In the shape of Spotify's current_playback() with a Track as item, None when nothing is playing.
+        with self._lock:
+            if self.track is None:
+                return None
+            return {
+                "is_playing": self.is_playing,
+                "progress_ms": self.get_progress_ms(time.monotonic()),
+                "item": self.track,
+                "device": {"name": self.device_name},
+            }
@@ -0,0 +1,54 @@
+import bisect
+import hashlib
+
+from db import get_playlist_account_uids, get_playlist_assignment, save_playlist_assignment, has_spotify_details, \
+    get_setting
+
+REPLICAS = 100  # Points on the ring per account, more points spread the channels more evenly
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring, adding an account only moves the channels that land on its new points."""
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self._points = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, _ in self._points]
+
+    def get(self, key):
+        if len(self._points) == 0:
+            return None
+        i = bisect.bisect(self._keys, _hash(str(key))) % len(self._points)
+        return self._points[i][1]
+
+
+def get_linked_playlist_accounts():
+    return [uid for uid in get_playlist_account_uids() if has_spotify_details(uid)]
+
+
+def get_legacy_playlist_account():
+    # The only playlist account before there could be several. Its room playlists were created without assignments.
+    return get_setting("playlist_account_uid")
+
+
+def get_playlist_account(voice_channel_id, has_legacy_playlist=None):
+    # Once a channel has a playlist account it keeps it, so adding accounts never moves existing playlists. A channel
+    # without one that already has a playlist on the legacy account stays there, has_legacy_playlist(account_uid,
+    # voice_channel_id) tells if it has.
+    account_uid = get_playlist_assignment(voice_channel_id)
+    if account_uid is not None:
+        return account_uid
+
+    linked_accounts = get_linked_playlist_accounts()
+    account_uid = HashRing(linked_accounts).get(voice_channel_id)
+    if account_uid is None:
+        raise IndexError("No playlist accounts linked!")
+    legacy_uid = get_legacy_playlist_account()
+    if account_uid != legacy_uid and legacy_uid in linked_accounts and has_legacy_playlist is not None:
+        if has_legacy_playlist(legacy_uid, voice_channel_id):
+            account_uid = legacy_uid
+    save_playlist_assignment(voice_channel_id, account_uid)
+    return account_uid
@@ -0,0 +1,169 @@
+import asyncio
+import math
+import textwrap
+import time
+
+import discord
+
+from spotify_control import SpotifyController
+
+PAGE_SIZE = 15
+PREV_PAGE, REFRESH, NEXT_PAGE = "⬅️", "🔄", "➡️"
+NAVIGATION = (PREV_PAGE, REFRESH, NEXT_PAGE)
+
+# Shortened "artist - title" per track id, shortening is the expensive part of rendering a queue.
+MAX_CACHED_TITLES = 10000
+_titles = {}
+
+
+def format_title(track):
+    title = _titles.get(track.id)
+    if title is None:
+        title = textwrap.shorten(SpotifyController.format_full_title(track), width=64, placeholder="...")
+        if track.id is not None:  # Local files have no id
+            if len(_titles) >= MAX_CACHED_TITLES:
+                _titles.clear()
+            _titles[track.id] = title
+    return title
+
+
+def format_duration(duration_ms, left=False):
+    duration_m, duration_s = divmod(duration_ms // 1000, 60)
+    return f"{duration_m}:{duration_s:02}{' left' if left else ''}"
+
+
+class QueueView:
+    """
+    The live queue message of a voice channel. It is edited in place instead of posting a new message every time, at
+    most once every edit_interval seconds. Requests that come in while an update is pending share that update, if they
+    are for the same text channel.
+    """
+
+    def __init__(self, controller, prefix, edit_interval=2, reuse_timeout=120):
+        self.controller = controller
+        self.prefix = prefix
+        self.edit_interval = edit_interval
+        self.reuse_timeout = reuse_timeout
+        self.message = None
+        self.sent_at = None
+        self.text = None
+        self.last_update = 0
+        self.page = None  # None follows the current track
+        self.snapshot = None
+        self._pending = None
+        self._pending_channel = None
+
+    def fetch(self):
+        queue, is_playing, current_index, current_progress_ms = self.controller.get_queue()
+        return queue, is_playing, current_index, current_progress_ms, self.controller.get_playback_info()
+
+    def get_page(self):
+        queue, is_playing, current_index = self.snapshot[0], self.snapshot[1], self.snapshot[2]
+        pages = max(math.ceil(len(queue) / PAGE_SIZE), 1)
+        if self.page is None:
+            page = current_index // PAGE_SIZE if current_index is not None and is_playing else 0
+        else:
+            page = self.page
+        return min(max(page, 0), pages - 1), pages
+
+    def render(self):
+        queue, is_playing, current_index, current_progress_ms, playback_info = self.snapshot
+        queue_text = ""
+        index_padding = len(str(len(queue)))
+
+        # Current index none and progress not none, means we are playing on the bot, but not playing from the playlist.
+        if current_index is None and current_progress_ms is not None:
+            queue_text += "{-# Currently playing a custom song or playlist. #-}\n"
+            queue_text += f"-- To switch back to room playlist use {self.prefix}start --\n\n"
+            if playback_info is not None and playback_info['item'] is not None:
+                track = playback_info['item']
+                duration = format_duration(track.duration_ms - current_progress_ms, left=True)
+                queue_text += f"current) {format_title(track)} {duration}\n\n"
+        elif current_index is None:
+            if is_playing:
+                queue_text += "{-# Linked spotify account is playing something elsewhere. #-}\n"
+            else:
+                queue_text += "{-# Currently not playing anything. #-}\n"
+            queue_text += f"-- To start playing the room playlist here use {self.prefix}start --\n\n"
+
+        page, pages = self.get_page()
+        start = page * PAGE_SIZE
+        for i, track in enumerate(queue[start:start + PAGE_SIZE], start=start):
+            is_current = i == current_index and is_playing
+            duration_ms = track.duration_ms - current_progress_ms if is_current else track.duration_ms
+            line = f" {(i+1):{index_padding}d}) {format_title(track)} {format_duration(duration_ms, is_current)}\n"
+            if is_current:
+                line = f"{' ' * (index_padding + 4)}⬐ current track\n{line}{' ' * (index_padding + 4)}⬑ current track\n"
+            queue_text += line
+
+        if len(queue) == 0:
+            queue_text += "-- Nothing in queue! --\n"
+        else:
+            more = len(queue) - min(start + PAGE_SIZE, len(queue))
+            if more > 0:
+                queue_text += f"\n {' ' * index_padding} -- {more} more track(s) --\n"
+            else:
+                queue_text += f"\n {' ' * index_padding} -- This is the end of the queue! --\n"
+                queue_text += f" {' ' * index_padding} -- Use {self.prefix}add to add more. --\n"
+            if pages > 1:
+                queue_text += f" {' ' * index_padding} -- Page {page + 1}/{pages} --\n"
+        return f"```hs\n{queue_text}```"
+
+    def is_reusable(self, channel):
+        return self.message is not None and self.message.channel.id == channel.id and \
+            time.monotonic() - self.sent_at < self.reuse_timeout
+
+    async def show(self, channel):
+        # Jump back to the current track. Post a new message if the old one is in another channel or scrolled away.
+        self.page = None
+        await self.wait_for_other_channels(channel)
+        if not self.is_reusable(channel):
+            self.message = None
+        await self.update(channel)
+
+    async def turn_page(self, delta):
+        if self.snapshot is None or self.message is None:
+            return
+        self.page = self.get_page()[0] + delta
+        await self.update(self.message.channel, fetch=False)
+
+    async def wait_for_other_channels(self, channel):
+        # Until no update for another channel is pending. Those don't reply to this channel.
+        while self._pending is not None and self._pending_channel.id != channel.id:
+            await asyncio.wait([self._pending])
+
+    async def update(self, channel, fetch=True):
+        await self.wait_for_other_channels(channel)
+        if self._pending is None:
+            self._pending_channel = channel
+            self._pending = asyncio.ensure_future(self._update(channel, fetch))
+        pending = self._pending
+        await asyncio.shield(pending)
+
+    async def send(self, channel, text):
+        self.message = await channel.send(text)
+        self.sent_at, self.text = time.monotonic(), text
+        for emoji in NAVIGATION:
+            await self.message.add_reaction(emoji)
+
+    async def _update(self, channel, fetch):
+        try:
+            wait = self.last_update + self.edit_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if fetch or self.snapshot is None:
+                self.snapshot = await asyncio.get_event_loop().run_in_executor(None, self.fetch)
+
+            text = self.render()
+            if self.message is None:
+                await self.send(channel, text)
+            elif text != self.text:
+                try:
+                    await self.message.edit(content=text)
+                    self.text = text
+                except discord.NotFound:
+                    # Someone deleted the message
+                    await self.send(channel, text)
+        finally:
+            self.last_update = time.monotonic()
+            self._pending = self._pending_channel = None
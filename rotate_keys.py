@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+from security import EncryptionTool
+from utils import load_config, get_encryption_tool
+
+BATCH_SIZE = 500
+CURSOR_KEY = "key_rotation_cursor"
+
+
+def rotate_keys(conn, tool, batch_size=BATCH_SIZE):
+    # Re-encrypts all stored oAuth tokens with the current key, one batch (and one transaction) at a time. Progress is
+    # saved in the meta table, so an interrupted run continues where it left off. Rows are only updated if they didn't
+    # change since they were read, so this can safely run while the bot is running.
+    row = conn.execute("SELECT value FROM meta WHERE key=?;", (CURSOR_KEY, )).fetchone()
+    cursor = int(row[0]) if row is not None else -2 ** 63
+    rotated, skipped, failed = 0, 0, 0
+
+    while True:
+        rows = conn.execute("SELECT discord_uid, oauth_refresh FROM spotify_details "
+                            "WHERE discord_uid>? AND oauth_refresh IS NOT NULL ORDER BY discord_uid LIMIT ?;",
+                            (cursor, batch_size)).fetchall()
+        if len(rows) == 0:
+            break
+
+        with conn:
+            for discord_uid, ciphertext in rows:
+                if tool.is_current(ciphertext):
+                    skipped += 1
+                    continue
+                try:
+                    new_ciphertext = tool.rotate(ciphertext)
+                except EncryptionTool.InvalidKey:
+                    print(f"Could not decrypt token of {discord_uid} with any of the configured keys.")
+                    failed += 1
+                    continue
+                conn.execute("UPDATE spotify_details SET oauth_refresh=? WHERE discord_uid=? AND oauth_refresh=?;",
+                             (new_ciphertext, discord_uid, ciphertext))
+                rotated += 1
+            cursor = rows[-1][0]
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?);", (CURSOR_KEY, str(cursor)))
+
+    with conn:
+        conn.execute("DELETE FROM meta WHERE key=?;", (CURSOR_KEY, ))
+    return rotated, skipped, failed
+
+
+def benchmark(rows, batch_size):
+    # Rotates that many made up tokens in a new database, returns the seconds it took and the peak traced memory.
+    old_key = EncryptionTool.generate()
+    old_tool, tool = EncryptionTool(old_key), EncryptionTool(EncryptionTool.generate(), [old_key])
+    token_info = json.dumps({"access_token": "a" * 300, "token_type": "Bearer", "expires_in": 3600,
+                             "refresh_token": "r" * 130, "scope": "user-read-playback-state", "expires_at": 0})
+    with tempfile.TemporaryDirectory() as directory:
+        conn = sqlite3.connect(os.path.join(directory, "db.sqlite"))
+        conn.execute("CREATE TABLE meta (key varchar(191) not null primary key, value varchar(191) not null);")
+        conn.execute("CREATE TABLE spotify_details (discord_uid int not null primary key, username text, "
+                     "oauth_refresh text);")
+        ciphertext = old_tool.encrypt(token_info)  # Encrypting every row would take as long as the rotation
+        with conn:
+            conn.executemany("INSERT INTO spotify_details (discord_uid, username, oauth_refresh) VALUES (?, ?, ?);",
+                             ((uid, f"user{uid}", ciphertext) for uid in range(rows)))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        rotated, skipped, failed = rotate_keys(conn, tool, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        stale = sum(1 for (c, ) in conn.execute("SELECT oauth_refresh FROM spotify_details;") if not tool.is_current(c))
+        conn.close()
+    if rotated != rows or stale != 0:
+        raise RuntimeError(f"{rotated} of {rows} rows rotated, {stale} still use the old key")
+    return seconds, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encrypt stored tokens with the current encryption key. Put the "
+                                                 "old key in 'encryption_old_key_passphrases' first.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--benchmark", type=int, nargs="+", metavar="ROWS",
+                        help="Rotate this many made up rows in a temporary database instead, and show the time and "
+                             "the peak memory it takes.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for count in args.benchmark:
+            seconds, peak = benchmark(count, args.batch_size)
+            print(f"{count} rows in {seconds:.1f}s ({count / seconds:.0f} rows/s), "
+                  f"peak memory {peak / 2 ** 20:.1f} MiB")
+        raise SystemExit(0)
+
+    conn = sqlite3.connect("db.sqlite")
+    start = time.perf_counter()
+    rotated, skipped, failed = rotate_keys(conn, get_encryption_tool(load_config()), batch_size=args.batch_size)
+    print(f"Rotated {rotated} tokens, {skipped} were already up to date, {failed} failed "
+          f"({time.perf_counter() - start:.1f}s).")
+    conn.close()
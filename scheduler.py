@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+import urllib3
+from spotipy import SpotifyException
+
+from log import get_logger
+
+log = get_logger("scheduler")
+
+# Request priorities, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+DEFAULT_RETRY_AFTER = 1  # seconds, for 429 responses without a Retry-After header
+# Status codes the HTTP client itself retries on. Not 429, it would sleep in the calling thread.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+RETRIES = 3
+
+
+def new_requests_session():
+    # For spotipy.Spotify(requests_session=...). spotipy's own session also retries 429s that have a Retry-After
+    # header, sleeping in the worker until the retries run out, and then raises an error without the header. Here
+    # 429s are raised right away, with their Retry-After header, so the scheduler can pause all requests.
+    retry = urllib3.Retry(total=RETRIES, connect=None, read=False, status=RETRIES, backoff_factor=0.3,
+                          allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                          status_forcelist=RETRY_STATUS_CODES, respect_retry_after_header=False,
+                          raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, now):
+        # Seconds until a token is available, 0 if there is one now.
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SpotifyScheduler:
+    """Runs all Spotify API calls of the bot, so they can be rate limited together.
+
+    Every call needs a token from the bucket of the app and from the bucket of the account (``key``) it is made for.
+    Interactive calls always go before bulk calls, and one worker is kept free of bulk calls. When Spotify answers
+    with 429, nothing is sent until the ``Retry-After`` time has passed, and the call is queued again.
+    """
+
+    def __init__(self, app_rate=10, app_burst=20, account_rate=5, account_burst=10, workers=4):
+        self.app_bucket = TokenBucket(app_rate, app_burst)
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.account_buckets = {}
+        self.max_bulk_running = max(1, workers - 1)
+        self.bulk_running = 0
+        self.retry_at = 0
+        # priority -> account key -> heap of that account's queued jobs, ordered by their sequence number
+        self._queues = {INTERACTIVE: {}, BULK: {}}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="spotify-api")
+        self._thread = threading.Thread(target=self._run, name="spotify-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, priority, func, *args, **kwargs):
+        future = Future()
+        self._push(priority, next(self._counter), key, func, args, kwargs, future)
+        return future
+
+    def call(self, key, priority, func, *args, **kwargs):
+        return self.submit(key, priority, func, *args, **kwargs).result()
+
+    def queue_depth(self):
+        with self._condition:
+            return {"interactive": self._queued(INTERACTIVE), "bulk": self._queued(BULK)}
+
+    def _queued(self, priority):
+        return sum(len(jobs) for jobs in self._queues[priority].values())
+
+    def _push(self, priority, seq, key, func, args, kwargs, future):
+        with self._condition:
+            heapq.heappush(self._queues[priority].setdefault(key, []), (priority, seq, key, func, args, kwargs, future))
+            self._condition.notify()
+
+    def _account_bucket(self, key):
+        bucket = self.account_buckets.get(key)
+        if bucket is None:
+            bucket = self.account_buckets[key] = TokenBucket(self.account_rate, self.account_burst)
+        return bucket
+
+    def _next_job(self):
+        # Called with the condition held. Returns a job that may run now, or the number of seconds to wait.
+        now = time.monotonic()
+        if now < self.retry_at:
+            return self.retry_at - now
+        app_wait = self.app_bucket.wait_time(now)
+        if app_wait > 0:
+            return app_wait
+
+        # The oldest job of an account that has a token, so only the accounts with queued jobs are looked at, not
+        # every job. A bulk storm queues thousands of jobs, but for a few accounts.
+        wait = None
+        for priority in (INTERACTIVE, BULK):
+            if priority == BULK and self.bulk_running >= self.max_bulk_running:
+                continue
+            accounts = self._queues[priority]
+            next_key = None
+            for key, jobs in accounts.items():
+                account_wait = self._account_bucket(key).wait_time(now)
+                if account_wait > 0:
+                    wait = account_wait if wait is None else min(wait, account_wait)
+                elif next_key is None or jobs[0][1] < accounts[next_key][0][1]:
+                    next_key = key
+            if next_key is None:
+                continue
+            jobs = accounts[next_key]
+            job = heapq.heappop(jobs)
+            if len(jobs) == 0:
+                del accounts[next_key]
+            self.app_bucket.take()
+            self._account_bucket(next_key).take()
+            if priority == BULK:
+                self.bulk_running += 1
+            return job
+        return wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    if not any(self._queues.values()):
+                        self._condition.wait()
+                        continue
+                    job = self._next_job()
+                    if not isinstance(job, tuple):
+                        # Nothing can run yet, wait for a token or for a new (or finished) job.
+                        self._condition.wait(timeout=job)
+                        job = None
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        priority, seq, key, func, args, kwargs, future = job
+        try:
+            result = func(*args, **kwargs)
+        except SpotifyException as e:
+            if e.http_status == 429:
+                retry_after = e.headers.get("Retry-After", DEFAULT_RETRY_AFTER)
+                log.warning("Spotify rate limit hit, pausing requests for %s seconds.", retry_after)
+                with self._condition:
+                    self.retry_at = max(self.retry_at, time.monotonic() + float(retry_after))
+                self._finish(priority)
+                # Same sequence number, so it keeps its place in the queue
+                self._push(priority, seq, key, func, args, kwargs, future)
+                return
+            self._finish(priority)
+            future.set_exception(e)
+        except Exception as e:
+            self._finish(priority)
+            future.set_exception(e)
+        else:
+            self._finish(priority)
+            future.set_result(result)
+
+    def _finish(self, priority):
+        with self._condition:
+            if priority == BULK:
+                self.bulk_running -= 1
+            self._condition.notify()
+
+
+class ScheduledSpotify:
+    """
+    Wraps a :class:`spotipy.Spotify` client, so all its API calls go through the scheduler. Calls wait for their turn
+    and their result, so don't make them on the event loop.
+    """
+
+    def __init__(self, api, scheduler, key, priority=INTERACTIVE):
+        self._api = api
+        self._scheduler = scheduler
+        self._key = key
+        self._priority = priority
+
+    def bulk(self):
+        return ScheduledSpotify(self._api, self._scheduler, self._key, priority=BULK)
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        def scheduled_call(*args, **kwargs):
+            return self._scheduler.call(self._key, self._priority, attr, *args, **kwargs)
+        return scheduled_call
+
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from track import Track
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class SearchBackend:
+    """Track search with a result cache, where concurrent searches for the same query share one API request."""
+
+    def __init__(self, ttl=3600, limit=5):
+        self.ttl = ttl
+        self.limit = limit
+        self._in_flight = {}
+
+    async def search(self, controller, query):
+        key = f"search:track:{normalize_query(query)}"
+        cache = controller.get_metadata_cache()
+        results = cache.get(key)
+        if results is not None:
+            return results
+
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(None, self._fetch, controller, normalize_query(query), key)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shield, so one cancelled command doesn't cancel the search for everyone waiting on it
+        return await asyncio.shield(future)
+
+    def _fetch(self, controller, query, key):
+        api = controller.get_playlist_api()
+        data = api.search(q=query, limit=self.limit, type="track")
+        results = [Track.from_dict(t) for t in data['tracks']['items']]
+        controller.get_metadata_cache().put(key, results, self.ttl)
+        return results
+
+
+class CandidateStore:
+    """Search results shown to a channel, so a user can pick one of them. Bounded, and entries expire."""
+
+    def __init__(self, timeout=120, max_channels=256):
+        self.timeout = timeout
+        self.max_channels = max_channels
+        self._candidates = OrderedDict()
+
+    def put(self, channel_id, tracks):
+        self._candidates[channel_id] = (time.monotonic() + self.timeout, tracks)
+        self._candidates.move_to_end(channel_id)
+        while len(self._candidates) > self.max_channels:
+            self._candidates.popitem(last=False)
+
+    def get(self, channel_id):
+        entry = self._candidates.get(channel_id)
+        if entry is None:
+            return None
+        expires_at, tracks = entry
+        if expires_at < time.monotonic():
+            del self._candidates[channel_id]
+            return None
+        return tracks
@@ -1,4 +1,4 @@
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
 
 class EncryptionTool:
@@ -9,8 +9,10 @@ class EncryptionTool:
     def generate(cls):
         return Fernet.generate_key()
 
-    def __init__(self, key):
-        self.suite = Fernet(key)
+    def __init__(self, key, old_keys=()):
+        # New data is always encrypted with `key`, the old keys can only decrypt. See rotate_keys.py
+        self.primary = Fernet(key)
+        self.suite = MultiFernet([self.primary] + [Fernet(k) for k in old_keys])
 
     def encrypt(self, message: str) -> str:
         return self.suite.encrypt(message.encode("utf-8")).decode("utf-8")
@@ -20,3 +22,17 @@ class EncryptionTool:
             return self.suite.decrypt(ciphertext.encode("utf-8")).decode("utf-8")
         except InvalidToken:
             raise EncryptionTool.InvalidKey()
+
+    def is_current(self, ciphertext: str) -> bool:
+        try:
+            self.primary.decrypt(ciphertext.encode("utf-8"))
+            return True
+        except InvalidToken:
+            return False
+
+    def rotate(self, ciphertext: str) -> str:
+        # Re-encrypts ciphertext made with any of the keys with the current key
+        try:
+            return self.suite.rotate(ciphertext.encode("utf-8")).decode("utf-8")
+        except InvalidToken:
+            raise EncryptionTool.InvalidKey()
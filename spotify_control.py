@@ -1,19 +1,30 @@
-import ctypes
 import json
 import os
 import random
+import secrets
+import select
 import socket
 import textwrap
-import threading
+import time
 import uuid
 from threading import Thread
-from typing import List
+from typing import Dict
 
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth, logger, SpotifyOauthError
 
-from db import get_spotify_token_info, add_or_update_spotify_token_info, get_setting, get_spotify_username
-from utils import load_config
+import control_protocol
+import udp_ingest
+from db import get_spotify_token_info, add_or_update_spotify_token_info, get_spotify_username, \
+    save_session, remove_session
+from drift import DriftCompensator
+from log import get_logger
+from metadata_cache import MetadataCache, slim_album, slim_playlist
+from playback_state import PlaybackState
+from playlist_accounts import get_playlist_account
+from scheduler import SpotifyScheduler, ScheduledSpotify, new_requests_session
+from track import Track
+from utils import load_config, get_readable_bytes, set_pipe_size
 
 SAMPLE_RATE = 44100
 CHANNELS = 2
@@ -21,20 +32,40 @@ BITS = 16
 SAMPLE_SIZE = (SAMPLE_RATE * BITS * CHANNELS) // 8
 CHUNK_SIZE = SAMPLE_SIZE // 4  # ~ 0.25 seconds
 BUFFER_SIZE = SAMPLE_SIZE  # ~ 1 second
+PIPE_SIZE = SAMPLE_SIZE * 2  # ~ 2 seconds, more than the backlog the drift compensation allows
+STOP_TIMEOUT = 2  # seconds to wait for the audio thread to exit
+QUEUE_CACHE_TTL = 30  # seconds, the playlist can also be changed outside of the bot
+PLAYLIST_NAME = "Spoofy Bot {}"  # Room playlist of a voice channel
 
 
 class SpotifyAuthManger(SpotifyOAuth):
+    # Decrypted token info by discord uid, shared by all auth managers so API calls don't need a database round trip.
+    _token_cache = {}
+
     def __init__(self, discord_uid, *args, **kwargs):
         self.discord_uid = discord_uid
         super(SpotifyAuthManger, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def load_token_info(cls, discord_uid):
+        token_info = cls._token_cache.get(str(discord_uid))
+        if token_info is None:
+            token_info_string = get_spotify_token_info(discord_uid)
+            if token_info_string is None:
+                return None
+            token_info = cls._token_cache[str(discord_uid)] = json.loads(token_info_string)
+        return token_info
+
+    @classmethod
+    def forget(cls, discord_uid):
+        cls._token_cache.pop(str(discord_uid), None)
+
     def get_cached_token(self):
         """ Gets a cached auth token
         """
         token_info = None
         try:
-            token_info_string = get_spotify_token_info(self.discord_uid)
-            token_info = json.loads(token_info_string)
+            token_info = SpotifyAuthManger.load_token_info(self.discord_uid)
 
             # if scopes don't match, then bail
             if "scope" not in token_info or not self._is_scope_subset(
@@ -47,11 +78,14 @@ class SpotifyAuthManger(SpotifyOAuth):
                     token_info["refresh_token"]
                 )
         except Exception as e:
+            # The token may have been changed by another process (e.g. relinked), read it again next time.
+            SpotifyAuthManger.forget(self.discord_uid)
             logger.warning(f"Couldn't read cache: {e}")
 
         return token_info
 
     def _save_token_info(self, token_info):
+        SpotifyAuthManger._token_cache[str(self.discord_uid)] = token_info
         try:
             add_or_update_spotify_token_info(uid=self.discord_uid, token_info=json.dumps(token_info))
         except Exception as e:
@@ -74,90 +108,262 @@ class SpotifyAuthManger(SpotifyOAuth):
         raise SpotifyOauthError("Interactive function `get_auth_response()` called but ignored.")
 
 
-def audio_listener_thread(controller: 'SpotifyController', port: int, output_io):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-    sock.bind(("0.0.0.0", port))
-    sock.listen(1)
-    while controller.is_listening:
-        connection, address = sock.accept()
-        print(f"Incoming socket connection on port {port} from {address}")
+def raw_audio_session(controller: 'SpotifyController', connection: socket.socket, output_io, received=b""):
+    # Old clients stream raw PCM without any framing, received is the audio that was already read from the connection.
+    # Returns True if the wakeup pipe fired.
+    wakeup = controller.wakeup_r
+    compensator = controller.new_drift_compensator()
+    try:
+        if len(received) > 0:
+            compensator.write(output_io, received, controller.get_audio_backlog(connection), time.monotonic())
+        while True:
+            readable, _, _ = select.select([connection, wakeup], [], [])
+            if wakeup in readable:
+                return True
+            data = connection.recv(CHUNK_SIZE)
+            if len(data) == 0:
+                controller.log.info("Client has disconnected")
+                return False
+            now = time.monotonic()
+            compensator.write(output_io, data, controller.get_audio_backlog(connection), now)
+            controller.last_audio_at = now
+    finally:
+        controller.log.info("Clock drift: %s", compensator.summary())
+
+
+def audio_listener_thread(controller: 'SpotifyController', sock: socket.socket, output_io):
+    # The listener never blocks in accept() or recv() directly. It always waits on the socket together with the
+    # controller's wakeup pipe, so stop() can end this thread at any time by writing a byte to the pipe.
+    wakeup = controller.wakeup_r
+    try:
+        while controller.is_listening:
+            readable, _, _ = select.select([sock, wakeup], [], [])
+            if wakeup in readable:
+                break
+            connection, address = sock.accept()
+            controller.log.info("Incoming socket connection from %s", address)
+            controller.client_connected_at = time.monotonic()
+            try:
+                # Clients speaking the control protocol announce it in their first bytes
+                is_control_client, received = control_protocol.is_control_client(connection, wakeup)
+                if is_control_client is None:
+                    stop = not controller.is_listening
+                elif is_control_client:
+                    stop = control_protocol.serve(controller, connection, output_io, wakeup)
+                else:
+                    stop = raw_audio_session(controller, connection, output_io, received)
+                if stop:
+                    return
+            except BrokenPipeError:
+                controller.log.warning("Client app disconnected or there are connection problems.")
+            except (control_protocol.ProtocolError, OSError) as e:
+                controller.log.warning("Closing client connection - %s", e)
+            except Exception:
+                # A bug in handling one connection shouldn't stop the session from accepting the next one
+                controller.log.exception("Closing client connection after an unexpected error")
+            finally:
+                connection.close()
+    finally:
+        sock.close()
+        if controller.udp_socket is not None:
+            controller.udp_socket.close()
         try:
-            clear_buffer_trigger = 1
-            while True:
-                if clear_buffer_trigger % 60 == 0:
-                    clear_buffer_trigger = 0
-                    try:
-                        connection.setblocking(False)
-                        try:
-                            while True:
-                                data = connection.recv(256)
-                                if len(data) == 0:
-                                    raise ValueError("No data read")
-                        except (socket.timeout, BlockingIOError):
-                            pass  # The buffer is empty
-                        except ValueError as e:
-                            print(f"Client has disconnected - {e}")
-                            break
-                    except BlockingIOError as e:
-                        print(f"Could not clear buffers - {e}")
-                    finally:
-                        connection.setblocking(True)
-                # Read and write a 0.25 second block of audio to the output
-                output_io.write(connection.recv(CHUNK_SIZE))
-                clear_buffer_trigger = (clear_buffer_trigger + 1)
-        except BrokenPipeError:
-            print("Client app disconnected or there are connection problems.")
-        finally:
-            connection.close()
-    sock.close()
+            output_io.close()
+        except OSError:
+            pass  # Nobody is reading the pipe anymore, buffered audio can be thrown away
+
+
+def close_after_thread(thread, fds):
+    thread.join()
+    for fd in fds:
+        os.close(fd)
 
 
 class SpotifyController:
-    _instances: List['SpotifyController'] = []
+    # Running controllers, indexed by voice channel id and by link code
+    _instances: Dict[int, 'SpotifyController'] = {}
+    _instances_by_link_code: Dict[str, 'SpotifyController'] = {}
 
-    def __init__(self, voice_channel_id: str, bitrate: int, discord_uid: str):
+    # Set by main.py when running as one of several worker processes, every worker gets its own slice of ports.
+    worker_id = 0
+    port_range = range(15001, 16000)
+
+    # Called with a controller when a client asks to start playback over the control protocol, set by the web app.
+    start_handler = None
+
+    # Shared by all controllers, created on first use
+    metadata_cache: MetadataCache = None
+    scheduler: SpotifyScheduler = None
+    account_apis = {}
+    legacy_playlist_names = None
+
+    def __init__(self, voice_channel_id: str, bitrate: int, discord_uid: str, link_code: str = None,
+                 playlist_id: str = None, device_id: str = None):
         self.voice_channel_id: str = voice_channel_id
+        self.log = get_logger("session", channel=voice_channel_id)
         self.bitrate = bitrate
         self.server_socket = None
+        self.udp_socket = None
         self.socket_io_r = None
         self.socket_io_w = None
+        self.wakeup_r = None
+        self.wakeup_w = None
         self.audio_thread = None
+        self.audio_input = None
+        self.audio_source = None
+        self.broadcast = None
         self.port = None
-        self.link_code = str(uuid.uuid4())
+        self.link_code = link_code if link_code is not None else str(uuid.uuid4())
         self.username = None
         self.discord_uid = discord_uid
         self.playlist = None
+        if playlist_id is not None:
+            # Restored session, the playlist is known so we don't have to look it up again.
+            self.playlist = {"id": playlist_id, "uri": f"spotify:playlist:{playlist_id}"}
+        self.device_id = device_id
+        self.api = None
+        self.playlist_api = None
         self.bot_config = load_config()
         self.is_listening = False
 
+        # Control protocol connection of the client app, if it speaks it. The resume token lets a reconnecting client
+        # continue this session.
+        self.control = None
+        self.resume_token = secrets.token_hex(16)
+        self.playback = PlaybackState()
+
+        # Room playlist items, cached until the playlist is changed by the bot or QUEUE_CACHE_TTL passes
+        self.queue_items = None
+        self.queue_fetched_at = None
+
+        # Activity timestamps (time.monotonic()), used to find and reap idle sessions.
+        self.created_at = time.monotonic()
+        self.client_connected_at = None
+        self.last_audio_at = None
+        self.last_command_at = self.created_at
+        self.empty_since = None
+
+    def on_client_event(self, event):
+        try:
+            if not self.playback.apply_event(event, self.bot_config['spotify_connect_name']):
+                self.log.warning("Unknown client event: %s", event.get('event'))
+        except ValueError as e:
+            self.log.warning("Ignoring client event %s - %s", event.get('event'), e)
+
+    def send_control(self, action, **kwargs):
+        # Returns False if the client is not connected with the control protocol.
+        control = self.control
+        if control is None:
+            return False
+        try:
+            control.send_json(control_protocol.CONTROL, {"action": action, **kwargs})
+        except OSError:
+            return False
+        return True
+
+    def touch(self):
+        self.last_command_at = time.monotonic()
+
+    def set_channel_empty(self, is_empty):
+        if not is_empty:
+            self.empty_since = None
+        elif self.empty_since is None:
+            self.empty_since = time.monotonic()
+
+    def get_idle_reason(self, no_client_timeout, idle_timeout, empty_channel_timeout):
+        # Returns why this session should be stopped, or None if it is still in use. Timeouts are in seconds.
+        now = time.monotonic()
+        if self.empty_since is not None and now - self.empty_since > empty_channel_timeout:
+            return "everyone left the voice channel"
+        if self.client_connected_at is None:
+            if now - self.created_at > no_client_timeout:
+                return "client app never connected"
+            return None
+        last_activity = max(self.last_command_at, self.last_audio_at or self.client_connected_at)
+        if now - last_activity > idle_timeout:
+            return "no audio or commands received"
+        return None
+
+    def persist(self):
+        save_session(self.voice_channel_id, self.link_code, self.port, self.discord_uid,
+                     self.playlist["id"] if self.playlist is not None else None, self.device_id,
+                     SpotifyController.worker_id)
+
+    @classmethod
+    def get_scheduler(cls, config):
+        if cls.scheduler is None:
+            cls.scheduler = SpotifyScheduler(app_rate=config['spotify_app_rate'],
+                                             app_burst=config['spotify_app_burst'],
+                                             account_rate=config['spotify_account_rate'],
+                                             account_burst=config['spotify_account_burst'],
+                                             workers=config['spotify_api_workers'])
+        return cls.scheduler
+
+    @classmethod
+    def get_playlist_account_api(cls, account_uid, config):
+        # Playlist account clients are shared by all controllers using that account
+        api = cls.account_apis.get(account_uid)
+        if api is None:
+            api = cls.account_apis[account_uid] = ScheduledSpotify(spotipy.Spotify(auth_manager=SpotifyAuthManger(
+                discord_uid=account_uid,
+                client_id=config['spotify_client_id'],
+                client_secret=config['spotify_client_secret'],
+                redirect_uri=config['spotify_redirect_uri_playlist'],
+                scope=config['spotify_scopes_playlist'],
+            ), requests_session=new_requests_session()), cls.get_scheduler(config), key=account_uid)
+        return api
+
     def get_api(self):
-        return spotipy.Spotify(auth_manager=SpotifyAuthManger(
-            discord_uid=self.discord_uid,
-            client_id=self.bot_config['spotify_client_id'],
-            client_secret=self.bot_config['spotify_client_secret'],
-            redirect_uri=self.bot_config['spotify_redirect_uri'],
-            scope=self.bot_config['spotify_scopes'],
-        ))
+        if self.api is None:
+            self.api = ScheduledSpotify(spotipy.Spotify(auth_manager=SpotifyAuthManger(
+                discord_uid=self.discord_uid,
+                client_id=self.bot_config['spotify_client_id'],
+                client_secret=self.bot_config['spotify_client_secret'],
+                redirect_uri=self.bot_config['spotify_redirect_uri'],
+                scope=self.bot_config['spotify_scopes'],
+            ), requests_session=new_requests_session()), self.get_scheduler(self.bot_config), key=self.discord_uid)
+        return self.api
 
     def get_playlist_api(self):
-        return spotipy.Spotify(auth_manager=SpotifyAuthManger(
-            discord_uid=get_setting("playlist_account_uid"),
-            client_id=self.bot_config['spotify_client_id'],
-            client_secret=self.bot_config['spotify_client_secret'],
-            redirect_uri=self.bot_config['spotify_redirect_uri_playlist'],
-            scope=self.bot_config['spotify_scopes_playlist'],
-        ))
+        if self.playlist_api is None:
+            self.playlist_api = SpotifyController.get_playlist_account_api(self.get_playlist_account(), self.bot_config)
+        return self.playlist_api
+
+    def get_playlist_account(self):
+        return get_playlist_account(self.voice_channel_id, has_legacy_playlist=SpotifyController.has_legacy_playlist)
+
+    @classmethod
+    def has_legacy_playlist(cls, account_uid, voice_channel_id):
+        # The legacy account's playlists are listed once, new room playlists are only created for channels that have
+        # an account assigned already.
+        if cls.legacy_playlist_names is None:
+            api = cls.get_playlist_account_api(account_uid, load_config()).bulk()
+            username = get_spotify_username(account_uid)
+            names = set()
+            offset = 0
+            while True:
+                playlists = api.user_playlists(username, limit=50, offset=offset)
+                names.update(p["name"] for p in playlists["items"])
+                offset += 50
+                if playlists["next"] is None:
+                    break
+            cls.legacy_playlist_names = names
+        return PLAYLIST_NAME.format(voice_channel_id) in cls.legacy_playlist_names
+
+    def warm(self):
+        # Create both API clients and refresh their tokens now, instead of on the first command.
+        self.get_api().auth_manager.get_cached_token()
+        self.get_playlist_api().auth_manager.get_cached_token()
 
     def get_or_create_playlist(self):
         if self.playlist is not None:
             return self.playlist
 
-        api = self.get_playlist_api()
+        api = self.get_playlist_api().bulk()
 
         # Find existing playlist
-        pl_name = f"Spoofy Bot {self.voice_channel_id}"
-        username = get_spotify_username(get_setting("playlist_account_uid"))
+        pl_name = PLAYLIST_NAME.format(self.voice_channel_id)
+        username = get_spotify_username(self.get_playlist_account())
         limit = 50
         curr_offset = 0
         playlist = None
@@ -166,7 +372,7 @@ class SpotifyController:
             for p in playlists["items"]:
                 if p["name"] == pl_name:
                     playlist = p
-                    print(f"Found old playlist '{pl_name}'")
+                    self.log.info("Found old playlist '%s'", pl_name)
                     break
             curr_offset += limit
             if playlists["next"] is None:
@@ -175,34 +381,68 @@ class SpotifyController:
         if playlist is None:
             # Create playlist
             playlist = api.user_playlist_create(username, pl_name, public=True, collaborative=False)
-            print(f"Created playlist '{pl_name}'")
+            self.log.info("Created playlist '%s'", pl_name)
         else:
             # Check if found playlist is collaborative, and make it collaborative if it's not.
             if (not playlist["public"]) or playlist["collaborative"]:
                 api.playlist_change_details(playlist["id"], public=True, collaborative=False)
-                print(f"Changed playlist '{pl_name}' to public")
+                self.log.info("Changed playlist '%s' to public", pl_name)
 
         self.playlist = playlist
+        self.persist()
         return playlist
 
     def get_playlist_uri(self):
         return self.get_or_create_playlist()['uri']
 
-    def get_album_tracks(self, album_id):
+    def get_metadata_cache(self):
+        if SpotifyController.metadata_cache is None:
+            SpotifyController.metadata_cache = MetadataCache(max_items=self.bot_config['metadata_cache_size'],
+                                                             use_db=self.bot_config['metadata_cache_sqlite'])
+        return SpotifyController.metadata_cache
+
+    def get_item_info(self, item_type, item_id):
+        # Returns a Track, or the (slimmed down) album or playlist info. Raises SpotifyException for invalid items.
         api = self.get_playlist_api()
+        cache = self.get_metadata_cache()
+        uri = f"spotify:{item_type}:{item_id}"
+        if item_type == "track":
+            return cache.get_or_fetch(uri, self.bot_config['metadata_cache_ttl'],
+                                      lambda: Track.from_dict(api.track(item_id)))
+        elif item_type == "album":
+            return cache.get_or_fetch(uri, self.bot_config['metadata_cache_ttl'],
+                                      lambda: slim_album(api.album(item_id)))
+        elif item_type == "playlist":
+            return cache.get_or_fetch(uri, self.bot_config['metadata_cache_playlist_ttl'],
+                                      lambda: slim_playlist(api.playlist(item_id)))
+        raise ValueError(f"Type {item_type} not supported!")
+
+    def get_album_tracks(self, album_id):
+        return self.get_metadata_cache().get_or_fetch(f"spotify:album:{album_id}:tracks",
+                                                      self.bot_config['metadata_cache_ttl'],
+                                                      lambda: self.fetch_album_tracks(album_id))
+
+    def get_playlist_tracks(self, playlist_id):
+        # Playlists change, so their listings expire a lot sooner than albums
+        return self.get_metadata_cache().get_or_fetch(f"spotify:playlist:{playlist_id}:tracks",
+                                                      self.bot_config['metadata_cache_playlist_ttl'],
+                                                      lambda: self.fetch_playlist_tracks(playlist_id))
+
+    def fetch_album_tracks(self, album_id):
+        api = self.get_playlist_api().bulk()
         limit = 50
         offset = 0
         nxt = 1
         tracks = []
         while nxt is not None:
             res = api.album_tracks(album_id, limit=limit, offset=offset)
-            tracks.extend(res['items'])
+            tracks.extend(Track.from_dict(t) for t in res['items'])
             nxt = res['next']
             offset += limit
         return tracks
 
-    def get_playlist_tracks(self, playlist_id):
-        api = self.get_playlist_api()
+    def fetch_playlist_tracks(self, playlist_id):
+        api = self.get_playlist_api().bulk()
         limit = 50
         offset = 0
         nxt = 1
@@ -210,13 +450,18 @@ class SpotifyController:
         while nxt is not None:
             res = api.playlist_items(playlist_id, limit=limit, offset=offset)
             for item in res['items']:
-                tracks.append(item['track'])
+                # Local files and removed tracks have no track info
+                if item['track'] is not None:
+                    tracks.append(Track.from_dict(item['track']))
             nxt = res['next']
             offset += limit
         return tracks
 
-    def get_queue(self):
-        sp = self.get_api()
+    def get_queue_items(self):
+        now = time.monotonic()
+        if self.queue_items is not None and now - self.queue_fetched_at < QUEUE_CACHE_TTL:
+            return self.queue_items
+
         api = self.get_playlist_api()
         limit = 100
         offset = 0
@@ -224,29 +469,51 @@ class SpotifyController:
         has_next = True
         while has_next:
             data = api.playlist_items(self.get_or_create_playlist()["id"],
-                                      fields="next,items(track(id,name,duration_ms,artists))",
+                                      fields="next,items(track(id,uri,name,duration_ms,artists(name,external_urls)))",
                                       limit=limit, offset=offset)
             has_next = data['next'] is not None
             for x in data['items']:
-                items.append(x['track'])
+                items.append(Track.from_dict(x['track']))
             offset += limit
+        self.queue_items, self.queue_fetched_at = items, now
+        return items
+
+    def invalidate_queue(self):
+        self.queue_items = None
+
+    def get_playback_info(self):
+        # Like current_playback(), but answered from the state the client reports when possible.
+        if not self.playback.is_fresh(client_connected=self.control is not None):
+            self.playback.apply_playback(self.get_api().current_playback())
+        elif self.playback.track is None and self.playback.track_id is not None:
+            self.playback.set_track(self.get_item_info("track", self.playback.track_id))
+        return self.playback.to_playback_info()
+
+    def refresh_playback_info(self):
+        # Checks Spotify now, unless the client reports its state anyway.
+        if not (self.playback.client_reports and self.control is not None):
+            self.playback.invalidate()
+        return self.get_playback_info()
 
-        info = sp.current_playback()
+    def get_queue(self):
+        items = self.get_queue_items()
+
+        info = self.get_playback_info()
         is_playing, current_index, current_progress_ms = None, None, None
         if info is not None:
             is_playing = info['is_playing']
             if info['is_playing'] and info['device']['name'] == self.bot_config['spotify_connect_name']:
                 current_progress_ms = info['progress_ms']
                 for i, item in enumerate(items):
-                    if item['id'] == info['item']['id']:
+                    if item.id == info['item'].id:
                         current_index = i
                         break
 
         return items, is_playing, current_index, current_progress_ms
 
-    def is_playing_on_bot(self):
-        sp = self.get_api()
-        info = sp.current_playback()
+    def is_playing_on_bot(self, info=None):
+        if info is None:
+            info = self.get_playback_info()
         if info is not None:
             is_playing = info['is_playing']
             is_correct_device = info['device']['name'] == self.bot_config['spotify_connect_name']
@@ -254,8 +521,18 @@ class SpotifyController:
         else:
             return False
 
+    def add_to_playlist(self, uris):
+        # Adding a single track is interactive, importing a whole album or playlist is not.
+        api = self.get_playlist_api() if len(uris) <= 1 else self.get_playlist_api().bulk()
+        playlist_id = self.get_or_create_playlist()['id']
+        i, max_tracks = 0, 50
+        while i < len(uris):
+            api.playlist_add_items(playlist_id, items=uris[i:i+max_tracks])
+            i += max_tracks
+        self.invalidate_queue()
+
     def clear_playlist(self):
-        api = self.get_playlist_api()
+        api = self.get_playlist_api().bulk()
         playlist_id = self.get_or_create_playlist()['id']
         items = 1
         while items > 0:
@@ -263,10 +540,9 @@ class SpotifyController:
             to_remove = [x['track']['id'] for x in data['items']]
             items = data['total'] - len(to_remove)
             api.playlist_remove_all_occurrences_of_items(playlist_id, items=to_remove)
+        self.invalidate_queue()
 
-    def clear_current_track(self):
-        # Clear the currently playing track
-        # We do this by starting to play a single song a few ms before the end of the song
+    def get_device_id(self):
         sp = self.get_api()
         devices = sp.devices()["devices"]
         spoofy_device = [x for x in devices if x["name"] == "Spoofy Bot"]
@@ -275,14 +551,26 @@ class SpotifyController:
         else:
             raise IndexError()
 
+        if spoofy_device["id"] != self.device_id:
+            self.device_id = spoofy_device["id"]
+            self.persist()
+        return self.device_id
+
+    def clear_current_track(self):
+        # Clear the currently playing track
+        # We do this by starting to play a single song a few ms before the end of the song
+        sp = self.get_api()
+        device_id = self.get_device_id()
+
         # Start playing clearing track 200ms from the end
         try:
             sp.repeat("off")
             sp.shuffle(False)
         except spotipy.SpotifyException:
             pass
-        sp.start_playback(device_id=spoofy_device["id"], uris=['spotify:track:4uLU6hMCjMI75M1A2tKUQC'],
+        sp.start_playback(device_id=device_id, uris=['spotify:track:4uLU6hMCjMI75M1A2tKUQC'],
                           position_ms=213573-2000)
+        self.playback.invalidate()
 
     def stop_playlist_playback(self):
         # Stop playback if we are currently playing the room playlist and clear the currently playing track.
@@ -290,6 +578,7 @@ class SpotifyController:
         items, is_playing, current_index, current_progress_ms = self.get_queue()
         if current_index is not None:
             sp.pause_playback()
+            self.playback.set_playing(False)
             self.clear_current_track()
 
     def update_playlist(self):
@@ -312,37 +601,38 @@ class SpotifyController:
 
     def start_playback(self):
         sp = self.get_api()
-        devices = sp.devices()["devices"]
-        spoofy_device = [x for x in devices if x["name"] == "Spoofy Bot"]
-        if len(spoofy_device) > 0:
-            spoofy_device = spoofy_device[0]
-        else:
-            raise IndexError()
+        device_id = self.get_device_id()
 
         # Start playing the bot playlist on this device
-        sp.start_playback(device_id=spoofy_device["id"], context_uri=self.get_playlist_uri())
+        sp.start_playback(device_id=device_id, context_uri=self.get_playlist_uri())
+        self.playback.invalidate()
 
     @classmethod
     def format_artist(cls, track_info):
-        return textwrap.shorten(",".join([x['name'] for x in track_info['artists']]), width=25, placeholder="...")
+        # Takes a Track, or the info of an album
+        if isinstance(track_info, Track):
+            names = track_info.artists
+        else:
+            names = [x['name'] for x in track_info['artists']]
+        return textwrap.shorten(",".join(names), width=25, placeholder="...")
 
     @classmethod
     def format_full_title(cls, track_info):
-        artist = textwrap.shorten(",".join([x['name'] for x in track_info['artists']]), width=25, placeholder="...")
-        return f"{artist} - {track_info['name']}"
+        name = track_info.name if isinstance(track_info, Track) else track_info['name']
+        return f"{cls.format_artist(track_info)} - {name}"
 
     @classmethod
-    def format_title(cls, track_info):
-        return f"{track_info['name']}"
+    def format_title(cls, track):
+        return f"{track.name}"
 
     @classmethod
-    def format_album_name(cls, track_info):
-        return f"{track_info['album']['name']}"
+    def format_album_name(cls, track):
+        return f"{track.album_name}"
 
     @classmethod
     def format_progress(cls, playback_info):
         progress_ms = playback_info['progress_ms']
-        duration_ms = playback_info['item']['duration_ms']
+        duration_ms = playback_info['item'].duration_ms
         progress_s, duration_s = progress_ms // 1000, duration_ms // 1000
         progress_m, progress_s = divmod(progress_s, 60)
         duration_m, duration_s = divmod(duration_s, 60)
@@ -351,29 +641,35 @@ class SpotifyController:
         post = 19 - pre
         return f"{'▬' * pre}🔵{'▬' * post} {progress_m}:{progress_s:02} / {duration_m}:{duration_s:02}"
 
+    @classmethod
+    def get_metadata_cache_stats(cls):
+        if cls.metadata_cache is None:
+            return MetadataCache().stats()
+        return cls.metadata_cache.stats()
+
+    @classmethod
+    def get_scheduler_queue_depth(cls):
+        if cls.scheduler is None:
+            return {"interactive": 0, "bulk": 0}
+        return cls.scheduler.queue_depth()
+
     @classmethod
     def get_instances(cls):
-        return cls._instances
+        return list(cls._instances.values())
 
     @classmethod
     def get_instance(cls, voice_channel_id: str):
-        for inst in cls._instances:
-            if inst.voice_channel_id == voice_channel_id:
-                return inst
-        return None
+        return cls._instances.get(voice_channel_id)
 
     @classmethod
     def get_instance_by_link_code(cls, link_code: str):
-        for inst in cls._instances:
-            if inst.link_code == link_code:
-                return inst
-        return None
+        return cls._instances_by_link_code.get(link_code)
 
     @classmethod
     def remove_inst(cls, voice_channel_id):
-        inst = cls.get_instance(voice_channel_id)
+        inst = cls._instances.pop(voice_channel_id, None)
         if inst is not None:
-            cls._instances.remove(inst)
+            cls._instances_by_link_code.pop(inst.link_code, None)
 
     @classmethod
     def stop_for_channel(cls, voice_channel_id):
@@ -382,63 +678,132 @@ class SpotifyController:
             inst.stop()
 
     @classmethod
-    def create(cls, voice_channel_id, bitrate, discord_uid):
+    def create(cls, voice_channel_id, bitrate, discord_uid, link_code=None, port=None, playlist_id=None,
+               device_id=None):
         # Check if no existing instance exists
         inst = cls.get_instance(voice_channel_id)
         if inst is not None:
             raise ValueError("Instance for this channel already exists!")
 
-        inst = SpotifyController(voice_channel_id=voice_channel_id, bitrate=bitrate, discord_uid=discord_uid)
-        cls._instances.append(inst)
-        inst.setup_socket()
+        inst = SpotifyController(voice_channel_id=voice_channel_id, bitrate=bitrate, discord_uid=discord_uid,
+                                 link_code=link_code, playlist_id=playlist_id, device_id=device_id)
+        cls._instances[voice_channel_id] = inst
+        cls._instances_by_link_code[inst.link_code] = inst
+        try:
+            inst.setup_socket(port=port)
+        except OSError:
+            cls.remove_inst(voice_channel_id)
+            raise
+        inst.persist()
         return inst
 
     @classmethod
     def get_free_port(cls):
-        used_ports = set(inst.port for inst in cls._instances)
+        used_ports = set(inst.port for inst in cls._instances.values())
         try:
-            return random.choice(list(set(range(15001, 16000)).difference(used_ports)))
+            return random.choice(list(set(cls.port_range).difference(used_ports)))
         except IndexError:
             raise IndexError("No free ports available!")
 
     def set_username(self, username):
         self.username = username
 
-    def setup_socket(self):
+    def setup_socket(self, port=None):
         if self.audio_thread is None:
-            self.port = SpotifyController.get_free_port()
+            self.port = port if port is not None else SpotifyController.get_free_port()
+            self.log = get_logger("session", channel=self.voice_channel_id, port=self.port)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.bind(("0.0.0.0", self.port))
+                sock.listen(1)
+            except OSError:
+                sock.close()
+                raise
+            self.server_socket = sock
             self.socket_io_r, self.socket_io_w = os.pipe()
+            set_pipe_size(self.socket_io_w, PIPE_SIZE)
+            self.wakeup_r, self.wakeup_w = os.pipe()
             self.is_listening = True
             audio_thread = Thread(target=audio_listener_thread,
-                                  args=[self, self.port, os.fdopen(self.socket_io_w, 'wb', buffering=BUFFER_SIZE)])
+                                  args=[self, sock, os.fdopen(self.socket_io_w, 'wb', buffering=BUFFER_SIZE)])
             self.audio_thread = audio_thread
             audio_thread.start()
         else:
             raise ValueError("Already an audio thread running?!")
 
-    def get_id(self):
-        # returns id of the respective thread
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for tid, thread in threading._active.items():
-            if thread is self.audio_thread:
-                return tid
-
-    def kill_socket(self):
-        # Raise an exception in the running thread, to stop it.
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Could not stop audio thread.')
+    def get_udp_socket(self):
+        # The UDP socket on the same port number, opened for the first client that asks to send its audio over UDP.
+        # Most clients use TCP. Only called from the audio thread, which closes it. None if UDP audio isn't available.
+        if self.udp_socket is None and self.bot_config['audio_udp_ingest']:
+            try:
+                self.udp_socket = udp_ingest.open_socket(self.port)
+            except OSError as e:
+                self.log.warning("UDP audio not available - %s", e)
+        return self.udp_socket
+
+    def new_drift_compensator(self):
+        return DriftCompensator(target_latency=self.bot_config['audio_target_latency'],
+                                max_latency=self.bot_config['audio_max_latency'])
+
+    def get_audio_backlog(self, connection):
+        # Bytes received from the client that ffmpeg didn't read yet, in the socket and in the pipe.
+        return get_readable_bytes(connection) + get_readable_bytes(self.socket_io_r)
+
+    def open_audio_source(self):
+        # Imported here, so the web app of a coordinator process doesn't import discord.
+        from audio_converter import FFmpegSpotifyAudio, FFmpegSpotifyOpusAudio
+        from broadcast import BroadcastSource
+
+        # Replace a previous ffmpeg process (if any), but keep reading from the same pipe.
+        if self.audio_source is not None:
+            self.audio_source.cleanup()
+        if self.audio_input is None:
+            self.audio_input = os.fdopen(self.socket_io_r, 'rb', buffering=0)
+
+        # In 'ffmpeg_opus' mode ffmpeg also does the Opus encoding, so it doesn't compete with the bot for the GIL.
+        if self.bot_config['audio_encoder'] == "ffmpeg_opus":
+            self.audio_source = FFmpegSpotifyOpusAudio(self.audio_input, link_code=self.link_code, pipe=True,
+                                                       bitrate=min(self.bitrate // 1000, 512))
+        else:
+            self.audio_source = FFmpegSpotifyAudio(self.audio_input, link_code=self.link_code, pipe=True,
+                                                   silence_gate=self.bot_config['audio_silence_gate'])
+
+        # The session's channel and the channels it is relayed to all play the same encoded packets.
+        self.broadcast = BroadcastSource(self.audio_source)
+        return self.broadcast
 
     def stop(self):
-        # Stop subprocess
+        if self.wakeup_w is None:
+            return  # Already stopped
+
+        # Wake up the audio thread, it closes the sockets and the write end of the pipe on its way out.
+        self.send_control("disconnect", reason="session stopped")
         self.is_listening = False
-        self.kill_socket()
+        os.write(self.wakeup_w, b"\0")
 
-        # Join log threads
-        self.audio_thread.join(timeout=1)
+        # Stop ffmpeg and close the read end of the pipe, so the audio thread can't stay blocked on a full pipe.
+        if self.audio_source is not None:
+            self.audio_source.cleanup()
+        if self.audio_input is not None:
+            self.audio_input.close()
+        else:
+            os.close(self.socket_io_r)
+
+        self.audio_thread.join(timeout=STOP_TIMEOUT)
+        wakeup_fds = (self.wakeup_r, self.wakeup_w)
+        if self.audio_thread.is_alive():
+            # The thread may still be in select() on the wakeup pipe, and a new socket or pipe could get its fd number
+            # if it was closed now. Close it once the thread is gone.
+            self.log.error("Audio thread did not stop within %s seconds.", STOP_TIMEOUT)
+            Thread(target=close_after_thread, args=[self.audio_thread, wakeup_fds], daemon=True).start()
+        else:
+            close_after_thread(self.audio_thread, wakeup_fds)
+        self.wakeup_r = self.wakeup_w = None
+        self.audio_input = self.audio_source = self.broadcast = None
 
-        # Remove self from instance list
+        # Remove self from instance list, and forget the session so it's not restored on the next start
         SpotifyController.remove_inst(self.voice_channel_id)
+        remove_session(self.voice_channel_id)
+
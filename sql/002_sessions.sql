@@ -0,0 +1,18 @@
+create table sessions
+(
+	voice_channel_id int not null
+		constraint sessions_pk
+			primary key,
+	link_code varchar(191) not null,
+	port int not null,
+	discord_uid int not null,
+	playlist_id varchar(191),
+	device_id varchar(191)
+);
+
+create unique index sessions_link_code_uindex
+	on sessions (link_code);
+
+
+
+update meta set value = "2" where key = "db_version";
@@ -0,0 +1,8 @@
+alter table sessions add column worker_id int not null default 0;
+
+create index sessions_worker_id_index
+	on sessions (worker_id);
+
+
+
+update meta set value = "3" where key = "db_version";
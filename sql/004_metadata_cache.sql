@@ -0,0 +1,15 @@
+create table metadata_cache
+(
+	uri varchar(191) not null
+		constraint metadata_cache_pk
+			primary key,
+	data text not null,
+	expires_at int not null
+);
+
+create index metadata_cache_expires_at_index
+	on metadata_cache (expires_at);
+
+
+
+update meta set value = "4" where key = "db_version";
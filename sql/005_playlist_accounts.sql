@@ -0,0 +1,17 @@
+create table playlist_assignments
+(
+	voice_channel_id int not null
+		constraint playlist_assignments_pk
+			primary key,
+	account_uid varchar(191) not null
+);
+
+insert into meta ("key", "value")
+	select "playlist_account_uids", value from meta where key = "playlist_account_uid";
+
+insert into playlist_assignments (voice_channel_id, account_uid)
+	select voice_channel_id, (select value from meta where key = "playlist_account_uid") from sessions;
+
+
+
+update meta set value = "5" where key = "db_version";
@@ -0,0 +1,12 @@
+drop index if exists meta_key_uindex;
+
+drop index if exists link_tokens_discord_uid_uindex;
+
+drop index if exists spotify_details_discord_uid_uindex;
+
+create index link_tokens_valid_until_index
+	on link_tokens (valid_until);
+
+
+
+update meta set value = "6" where key = "db_version";
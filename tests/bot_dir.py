@@ -0,0 +1,31 @@
+"""Setup shared by the checks in this directory."""
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+import upgrade_db
+from utils import save_config
+
+SQL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql")
+
+
+@contextmanager
+def temporary_bot_dir(config):
+    # Runs the block in a new working directory with the config and an up to date database, like the bot's own.
+    previous, work_dir = os.getcwd(), tempfile.mkdtemp()
+    os.chdir(work_dir)
+    try:
+        save_config(config)
+        conn = sqlite3.connect("db.sqlite")
+        try:
+            with open(os.path.join(SQL_PATH, "000_db_create.sql")) as f:
+                conn.executescript(f.read())
+            upgrade_db.upgrade_db(conn, path=SQL_PATH)
+        finally:
+            conn.close()
+        yield work_dir
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(work_dir)
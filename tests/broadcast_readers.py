@@ -0,0 +1,61 @@
+"""
+Plays a broadcast source whose reads block for a while (like the silence gate) to a subscriber that is ahead, and
+checks that a subscriber that is behind and new subscribers are served without waiting for those reads.
+"""
+import argparse
+import sys
+import threading
+import time
+
+from discord import AudioSource
+
+from broadcast import BroadcastSource
+
+
+class SlowSource(AudioSource):
+    def __init__(self, packets, read_delay):
+        self.packets = packets
+        self.read_delay = read_delay
+        self.count = 0
+
+    def read(self):
+        time.sleep(self.read_delay)
+        self.count += 1
+        return b"packet %d" % self.count if self.count <= self.packets else b''
+
+    def is_opus(self):
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that slow source reads don't block other subscribers.")
+    parser.add_argument("--packets", type=int, default=20)
+    parser.add_argument("--read-delay", type=float, default=0.2, help="Seconds every read of the source blocks.")
+    args = parser.parse_args()
+
+    broadcast = BroadcastSource(SlowSource(args.packets, args.read_delay))
+    leader, follower = broadcast.subscribe(), broadcast.subscribe()
+    leader_thread = threading.Thread(target=lambda: [None for _ in iter(leader.read, b'')])
+    leader_thread.start()
+
+    slowest, received = 0, []
+    while True:
+        started = time.perf_counter()
+        if follower.position < broadcast.head:
+            received.append(follower.read())
+            broadcast.subscribe().cleanup()
+            slowest = max(slowest, time.perf_counter() - started)
+        elif not leader_thread.is_alive():
+            break
+        else:
+            time.sleep(0.001)
+    leader_thread.join()
+
+    ok = received == [b"packet %d" % i for i in range(1, args.packets + 1)] and slowest < args.read_delay / 2
+    print(f"Follower got {len(received)} of {args.packets} packets, slowest read and subscribe took "
+          f"{slowest * 1000:.1f} ms with {args.read_delay * 1000:.0f} ms source reads{'' if ok else ' FAILED'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+Runs every db.py helper against a new database, and checks with EXPLAIN QUERY PLAN that none of their queries scans a
+whole table. A changed query or migration can't silently lose its index.
+"""
+import sqlite3
+import sys
+from datetime import datetime
+from unittest import mock
+
+import db
+from main import DEFAULT_CONFIG
+from security import EncryptionTool
+from tests.bot_dir import temporary_bot_dir
+
+FULL_SCANS = {db._get_linked_uids}  # Meant to read the whole table
+
+
+class TracedSqlite:
+    """Stands in for the sqlite3 module in db.py only, and records the statements of its connections."""
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def connect(self, *args, **kwargs):
+        conn = sqlite3.connect(*args, **kwargs)
+        conn.set_trace_callback(self.statements.append)  # With the parameters filled in
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(sqlite3, name)
+
+
+def get_calls():
+    now = datetime.utcnow().timestamp()
+    return [
+        (db.get_setting, "db_version"),
+        (db.add_token, "nick", 1, "token", now + 600, None),
+        (db.has_tokens, 1),
+        (db.get_token_info, "token"),
+        (db.remove_token, "token"),
+        (db.remove_tokens, 1),
+        (db.purge_expired_tokens, ),
+        (db.add_or_update_spotify_token_info, 1, "{}"),
+        (db.add_or_update_spotify_details, 1, "user"),
+        (db._is_linked_db, 1),
+        (db._get_linked_uids, ),
+        (db.is_linked, 2),
+        (db.is_linked_spotify, "user"),
+        (db.has_spotify_details, 1),
+        (db.get_spotify_token_info, 1),
+        (db.get_spotify_username, 1),
+        (db.remove_spotify_details, 1),
+        (db.save_session, 10, "link code", 15001, 1, None, None, 0),
+        (db.get_sessions, 0),
+        (db.get_session_by_link_code, "link code"),
+        (db.remove_session, 10),
+        (db.save_cached_metadata, "spotify:track:x", "{}", now + 600),
+        (db.get_cached_metadata, "spotify:track:x", now),
+        (db.purge_cached_metadata, now),
+        (db.get_playlist_account_uids, ),
+        (db.save_playlist_assignment, 10, "1"),
+        (db.get_playlist_assignment, 10),
+    ]
+
+
+def main():
+    config = {**DEFAULT_CONFIG, "encryption_key_passphrase": EncryptionTool.generate().decode("utf-8")}
+    statements = []
+    failed = False
+    with temporary_bot_dir(config), mock.patch.object(db, "sqlite3", TracedSqlite(statements)):
+        conn = sqlite3.connect("db.sqlite")
+        try:
+            for func, *args in get_calls():
+                statements.clear()
+                func(*args)
+                for statement in statements:
+                    if statement.split()[0].upper() not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+                        continue
+                    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}")]
+                    ok = func in FULL_SCANS or not any(step.startswith("SCAN") for step in plan)
+                    failed = failed or not ok
+                    print(f"{'ok  ' if ok else 'FAIL'} {func.__name__}: {'; '.join(plan) or 'no lookup'}")
+        finally:
+            conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
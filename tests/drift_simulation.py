@@ -0,0 +1,90 @@
+"""
+Simulates hours of streaming from clients whose clocks run fast or slow, without waiting for them: each chunk is sent
+on the client's skewed clock and arrives late by its own random delay. The player reads at the bot's rate. Checks that
+once settled the backlog stays near the target, with nothing dropped and no underruns.
+"""
+import argparse
+import random
+import sys
+
+from drift import DriftCompensator, BYTES_PER_FRAME, BYTES_PER_SECOND
+
+
+class Sink:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def flush(self):
+        pass
+
+
+def simulate(skew_ppm, rnd, hours, chunk_seconds, jitter, settle):
+    # Returns the compensator, the lowest and highest latency after settling, the seconds of underrun and the rate
+    # correction that was applied in ppm.
+    compensator = DriftCompensator()
+    sink = Sink()
+    chunk = bytes(int(chunk_seconds * BYTES_PER_SECOND) // BYTES_PER_FRAME * BYTES_PER_FRAME)
+    interval = chunk_seconds / (1 + skew_ppm / 1e6)  # in bot time
+    backlog = 0.0  # bytes
+    playing_since = None  # The player starts once the target latency is buffered
+    last_arrival = 0.0
+    underrun = 0.0  # seconds the player had nothing to read
+    low = high = None
+    for i in range(int(hours * 3600 / interval)):
+        # The delay is drawn for every chunk on its own, but chunks can't overtake each other on a stream
+        arrival = max(i * interval + rnd.uniform(0, jitter), last_arrival)
+        if playing_since is not None:
+            backlog -= (arrival - last_arrival) * BYTES_PER_SECOND
+            if backlog < 0:
+                underrun += -backlog / BYTES_PER_SECOND if arrival > settle else 0
+                backlog = 0.0
+        last_arrival = arrival
+
+        written = sink.written
+        compensator.write(sink, chunk, int(backlog), arrival)
+        backlog += sink.written - written
+        if playing_since is None and backlog >= compensator.target_latency * BYTES_PER_SECOND:
+            playing_since = arrival
+        if arrival > settle:
+            latency = backlog / BYTES_PER_SECOND
+            low = latency if low is None else min(low, latency)
+            high = latency if high is None else max(high, latency)
+    corrected_ppm = (compensator.dropped - compensator.repeated) / (last_arrival * BYTES_PER_SECOND
+                                                                      / BYTES_PER_FRAME) * 1e6
+    return compensator, low, high, underrun, corrected_ppm
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate long sessions with skewed client clocks.")
+    parser.add_argument("--hours", type=float, default=2)
+    parser.add_argument("--skews", type=float, nargs="+", default=[-500, -200, -50, 0, 50, 200, 500],
+                        help="Client clock skews in ppm, positive sends faster than the bot plays.")
+    parser.add_argument("--jitter", type=float, default=0.03, help="Maximum delay of a chunk in seconds.")
+    parser.add_argument("--chunk", type=float, default=0.02, help="Seconds of audio per chunk.")
+    parser.add_argument("--settle", type=float, default=300, help="Seconds before the latency is checked.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    failed = False
+    for skew_ppm in args.skews:
+        compensator, low, high, underrun, corrected_ppm = simulate(skew_ppm, rnd, args.hours, args.chunk,
+                                                                   args.jitter, args.settle)
+        # A proportional controller settles off the target by the skew over the gain, plus the deadband, and the
+        # backlog swings by a chunk and the jitter around that.
+        allowed = (compensator.deadband + abs(skew_ppm) / 1e6 / compensator.gain + args.chunk + args.jitter)
+        ok = (compensator.dropped_bytes == 0 and underrun == 0 and low is not None
+              and compensator.target_latency - allowed <= low and high <= compensator.target_latency + allowed)
+        failed |= not ok
+        print(f"{skew_ppm:+6.0f} ppm: latency {low * 1000:.0f}-{high * 1000:.0f} ms "
+              f"(target {compensator.target_latency * 1000:.0f} ± {allowed * 1000:.0f} ms), corrected "
+              f"{corrected_ppm:+.0f} ppm, {underrun:.2f} s underrun, {compensator.summary()}"
+              f"{'' if ok else ' FAILED'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Runs a now playing watcher against a fake controller that plays one second tracks, so the playback is checked and
+changes more often than the message may be edited. Checks that it is never edited twice within edit_interval.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from now_playing import NowPlayingWatcher
+from spotify_control import SpotifyController
+from track import Track
+
+
+class FakeMessage:
+    def __init__(self):
+        self.edited_at = []
+
+    async def edit(self, embed):
+        self.edited_at.append(time.monotonic())
+
+
+class FakePlayback:
+    def __init__(self):
+        self.track, self.started_at = None, None
+
+    def to_playback_info(self):
+        if self.track is None:
+            return None
+        progress_ms = min(int((time.monotonic() - self.started_at) * 1000), self.track.duration_ms)
+        return {"is_playing": True, "progress_ms": progress_ms, "item": self.track, "device": {"name": "Fake"}}
+
+
+class FakeController:
+    voice_channel_id = "0"
+    log = SimpleNamespace(warning=print)
+
+    def __init__(self):
+        self.playback = FakePlayback()
+        self.checks = 0
+
+    def refresh_playback_info(self):
+        self.checks += 1
+        self.playback.track = Track(str(self.checks), f"spotify:track:{self.checks}", f"Track {self.checks}", 1000)
+        self.playback.started_at = time.monotonic()
+        return self.playback.to_playback_info()
+
+
+async def watch(watcher, duration):
+    watcher.start()
+    await asyncio.sleep(duration)
+    watcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check how often the now playing message is edited.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to run the watcher for.")
+    parser.add_argument("--edit-interval", type=float, default=5)
+    args = parser.parse_args()
+
+    controller, message = FakeController(), FakeMessage()
+    # The watcher runs as long as its controller is the session of the channel
+    with mock.patch.dict(SpotifyController._instances, {controller.voice_channel_id: controller}):
+        watcher = NowPlayingWatcher(controller, message, args.edit_interval)
+        asyncio.get_event_loop().run_until_complete(watch(watcher, args.duration))
+
+    gaps = [b - a for a, b in zip(message.edited_at, message.edited_at[1:])]
+    shortest = min(gaps, default=float("inf"))
+    print(f"{len(message.edited_at)} edits and {controller.checks} checks in {args.duration:.0f} s, "
+          f"shortest time between edits {shortest:.2f} s")
+    return 1 if shortest < args.edit_interval * 0.99 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
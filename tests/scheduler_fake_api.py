@@ -0,0 +1,123 @@
+"""
+Runs requests through the scheduler against a fake Spotify API on localhost. A 429 must reach the scheduler with its
+Retry-After header (without the HTTP client retrying it), and pause every request until then. Server errors are
+retried by the HTTP client. During a storm of bulk calls, the p99 latency of interactive calls must stay bounded.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import spotipy
+
+from scheduler import SpotifyScheduler, ScheduledSpotify, new_requests_session, INTERACTIVE, BULK
+
+
+def start_fake_spotify(responses, received, latency, retry_after):
+    # Answers with the status codes in responses (200 once it is empty) and records (time, path) in received.
+    class FakeSpotify(BaseHTTPRequestHandler):
+        def do_GET(self):
+            received.append((time.monotonic(), self.path))
+            status = responses.pop(0) if len(responses) > 0 else 200
+            time.sleep(latency)
+            body = json.dumps({"is_playing": True} if status == 200 else {"error": {"status": status, "message": ""}})
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", str(retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSpotify)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the scheduler against a fake Spotify API.")
+    parser.add_argument("--retry-after", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the fake API takes per request.")
+    parser.add_argument("--storm", type=float, default=20, help="Seconds of bulk import storm.")
+    parser.add_argument("--interactive-rate", type=float, default=4, help="Interactive calls per second.")
+    parser.add_argument("--max-p99", type=float, default=0.5, help="Allowed p99 interactive latency in seconds.")
+    args = parser.parse_args()
+
+    responses = []
+    received = []
+    server = start_fake_spotify(responses, received, args.latency, args.retry_after)
+    scheduler = SpotifyScheduler()
+
+    def new_client():
+        sp = spotipy.Spotify(auth="token", requests_session=new_requests_session())
+        sp.prefix = f"http://127.0.0.1:{server.server_address[1]}/v1/"
+        return sp
+
+    failures = []
+
+    def check(name, ok):
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+        if not ok:
+            failures.append(name)
+
+    # 429: one request to the API, then nothing (from any account) until Retry-After passed
+    responses[:] = [429]
+    received.clear()
+    started = time.monotonic()
+    first = scheduler.submit("a", INTERACTIVE, new_client().current_playback)
+    time.sleep(0.2)
+    other = scheduler.submit("b", INTERACTIVE, new_client().current_playback)
+    results = first.result(timeout=args.retry_after + 5), other.result(timeout=args.retry_after + 5)
+    check("429 returns a result after the pause", results == ({"is_playing": True}, {"is_playing": True}))
+    check("429 is not retried by the HTTP client", len(received) == 3)
+    check(f"no request during the {args.retry_after} s pause",
+          all(at - received[0][0] >= args.retry_after for at, _ in received[1:]))
+    check("the pause is not slept in a worker", time.monotonic() - started < args.retry_after + 1)
+
+    # Server errors are retried right away by the HTTP client, the scheduler doesn't pause
+    responses[:] = [503, 502]
+    received.clear()
+    started = time.monotonic()
+    result = ScheduledSpotify(new_client(), scheduler, key="a").current_playback()
+    check("5xx is retried by the HTTP client", result == {"is_playing": True} and len(received) == 3)
+    check("5xx doesn't pause the scheduler", time.monotonic() - started < 1)
+
+    # Bulk import storm: four playlist accounts import as fast as they may, together asking for more than the app's
+    # rate. Meanwhile users make interactive calls, which should only wait for a token and a single request.
+    bulk_calls = []
+    for account in range(4):
+        client = new_client()
+        bulk_calls += [scheduler.submit(f"playlist {account}", BULK, client.playlist_items, "x")
+                       for _ in range(int(args.storm * scheduler.account_rate))]
+    latencies = []
+    clients = [new_client() for _ in range(10)]
+    started = time.monotonic()
+    i = 0
+    while time.monotonic() - started < args.storm:
+        submitted = time.monotonic()
+        future = scheduler.submit(f"user {i % len(clients)}", INTERACTIVE, clients[i % len(clients)].current_playback)
+        future.add_done_callback(lambda _, at=submitted: latencies.append(time.monotonic() - at))
+        i += 1
+        time.sleep(max(started + i / args.interactive_rate - time.monotonic(), 0))
+    depth = scheduler.queue_depth()
+    time.sleep(1)
+    latencies = sorted(latencies + [float("inf")] * (i - len(latencies)))  # Calls that didn't finish yet
+    bulk_done = sum(1 for future in bulk_calls if future.done())
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"Storm: {len(latencies)} interactive calls, p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, "
+          f"p99 {p99 * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms. {bulk_done} of {len(bulk_calls)} bulk calls "
+          f"done, queue depth at the end {depth}")
+    check(f"interactive p99 below {args.max_p99 * 1000:.0f} ms during the storm", p99 < args.max_p99)
+    check("bulk calls kept running during the storm", bulk_done > args.storm * scheduler.app_bucket.rate / 2)
+
+    server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
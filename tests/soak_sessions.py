@@ -0,0 +1,63 @@
+"""
+Creates and stops many sessions, with a client streaming to some of them, and checks that no threads or file
+descriptors are left behind. Runs in a temporary directory with its own config and database.
+"""
+import argparse
+import gc
+import os
+import socket
+import sys
+import threading
+import time
+
+from log import setup_logging
+from main import DEFAULT_CONFIG
+from spotify_control import SpotifyController, PIPE_SIZE
+from tests.bot_dir import temporary_bot_dir
+
+
+def open_fds():
+    gc.collect()  # db.py leaves closing its sqlite connections to the garbage collector
+    return len(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that stopping sessions frees their threads and fds.")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--client-every", type=int, default=3, help="Connect a streaming client to every n-th session.")
+    args = parser.parse_args()
+
+    setup_logging("WARNING")
+    with temporary_bot_dir(DEFAULT_CONFIG):
+        threads_before, fds_before = threading.active_count(), open_fds()
+        started = time.perf_counter()
+        slowest_stop = 0
+        for i in range(args.sessions):
+            controller = SpotifyController.create(i, 64000, "0")
+            client = None
+            if i % args.client_every == 0:
+                # More audio than the pipe holds and nobody reading it, so the audio thread may be blocked on the pipe
+                client = socket.create_connection(("127.0.0.1", controller.port))
+                client.setblocking(False)
+                try:
+                    client.send(bytes(PIPE_SIZE * 2))
+                except BlockingIOError:
+                    pass
+                time.sleep(0.001)
+            stop_started = time.perf_counter()
+            controller.stop()
+            slowest_stop = max(slowest_stop, time.perf_counter() - stop_started)
+            if client is not None:
+                client.close()
+            if (i + 1) % 1000 == 0:
+                print(f"{i + 1} sessions, {threading.active_count() - threads_before} extra threads, "
+                      f"{open_fds() - fds_before} extra fds")
+        leaked_threads, leaked_fds = threading.active_count() - threads_before, open_fds() - fds_before
+
+    print(f"{args.sessions} sessions in {time.perf_counter() - started:.1f} s, "
+          f"slowest stop {slowest_stop * 1000:.0f} ms, {leaked_threads} threads and {leaked_fds} fds left behind")
+    return 1 if leaked_threads > 0 or leaked_fds > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""Measures the memory used by the tracks of one room queue, as API dicts and as Track objects."""
+import argparse
+import sys
+import tracemalloc
+
+from track import Track
+
+
+def api_track(i, artists_count=40):
+    # A made up track object, as returned by the playlist items endpoint
+    def artist(j):
+        return {"external_urls": {"spotify": f"https://open.spotify.com/artist/{j:022d}"},
+                "href": f"https://api.spotify.com/v1/artists/{j:022d}", "id": f"{j:022d}", "name": f"Artist {j}",
+                "type": "artist", "uri": f"spotify:artist:{j:022d}"}
+    album_id = f"{i // 12:022d}"
+    return {
+        "id": f"{i:022d}", "uri": f"spotify:track:{i:022d}", "name": f"Track number {i} (Remastered)",
+        "duration_ms": 180000 + i, "artists": [artist(i % artists_count), artist((i + 7) % artists_count)],
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{i:022d}"},
+        "album": {"id": album_id, "name": f"Album {i // 12}", "uri": f"spotify:album:{album_id}",
+                  "images": [{"url": f"https://i.scdn.co/image/{i // 12:040d}{size}", "height": size, "width": size}
+                             for size in (640, 300, 64)]},
+    }
+
+
+def measure(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return size
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory used by queues of tracks.")
+    parser.add_argument("sizes", type=int, nargs="*", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    for count in args.sizes:
+        # Every track is built from its own copy of the JSON, like after decoding an API response
+        dicts = measure(lambda: [api_track(i) for i in range(count)])
+        tracks = measure(lambda: [Track.from_dict(api_track(i)) for i in range(count)])
+        print(f"{count} tracks: {dicts / 2 ** 20:.1f} MiB as dicts, {tracks / 2 ** 20:.1f} MiB as Track objects "
+              f"({tracks / count:.0f} bytes per track)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
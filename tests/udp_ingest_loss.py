@@ -0,0 +1,85 @@
+"""
+Sends a synthetic stream over loopback with injected loss and reordering, and measures the gaps and the added latency
+in what the UDP jitter buffer plays.
+"""
+import argparse
+import random
+import socket
+import struct
+import sys
+import time
+
+from udp_ingest import UdpIngest, FLUSH_TIMEOUT, FRAME_SIZE, HEADER, encode_datagram, open_socket
+
+
+def test_frame(seq):
+    # Every frame of the test stream is its sequence number, repeated
+    return struct.pack("<I", seq) * (FRAME_SIZE // 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure UDP ingest under packet loss and reordering.")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--loss", type=float, default=0.02, help="Fraction of datagrams that is dropped.")
+    parser.add_argument("--burst", type=int, default=1, help="Datagrams lost in a row when a loss happens.")
+    parser.add_argument("--reorder", type=float, default=0.02, help="Fraction of datagrams that is delayed.")
+    parser.add_argument("--delay", type=int, default=2, help="Frames a reordered datagram is delayed by.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    receiver = open_socket(0)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ("127.0.0.1", receiver.getsockname()[1])
+    ingest = UdpIngest(receiver)
+
+    total = int(args.seconds * 50)
+    delayed = {}  # frame at which to send -> datagrams
+    lost_in_row = 0
+    sent_bytes = 0
+    played = []  # (time, frame)
+    start = time.perf_counter()
+    for seq in range(total):
+        time.sleep(max(start + seq * 0.02 - time.perf_counter(), 0))
+        datagram = encode_datagram(ingest.token, seq, test_frame(seq))
+        if lost_in_row > 0 or rnd.random() < args.loss / args.burst:
+            lost_in_row = (lost_in_row or args.burst) - 1
+        elif rnd.random() < args.reorder:
+            delayed.setdefault(seq + args.delay, []).append(datagram)
+        else:
+            sender.sendto(datagram, address)
+            sent_bytes += len(datagram)
+        for datagram in delayed.pop(seq, []):
+            sender.sendto(datagram, address)
+            sent_bytes += len(datagram)
+
+        time.sleep(0.001)  # Loopback delivers right away
+        now = time.perf_counter()
+        played += [(now, frame) for frame in ingest.receive(now) + ingest.poll(now)]
+    time.sleep(FLUSH_TIMEOUT)
+    now = time.perf_counter()
+    played += [(now, frame) for frame in ingest.receive(now) + ingest.poll(now)]
+
+    # Frames are played in order, so the n-th played frame should be frame n
+    gaps, gap, delays = [], 0, []
+    for seq, (played_at, frame) in enumerate(played):
+        if frame == test_frame(seq):
+            delays.append(played_at - (start + seq * 0.02))
+            if gap > 0:
+                gaps.append(gap)
+            gap = 0
+        else:
+            gap += 1
+    if gap > 0:
+        gaps.append(gap)
+    delays.sort()
+    print(f"{ingest.summary()}\n"
+          f"{len(played)} frames played for {total} sent, {sum(gaps)} concealed or faded in {len(gaps)} gaps, "
+          f"longest {max(gaps, default=0) * 20} ms\n"
+          f"Delay from send to play: p50 {delays[len(delays) // 2] * 1000:.1f} ms, "
+          f"p95 {delays[int(len(delays) * 0.95)] * 1000:.1f} ms, max {delays[-1] * 1000:.1f} ms\n"
+          f"{sent_bytes * 8 / args.seconds / 1000:.0f} kbit/s sent ({HEADER.size} byte header per frame)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import sys
+
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
+
+
+class Track:
+    """
+    A track (or podcast episode) as the bot keeps it, instead of Spotify's JSON. Ids and the strings that repeat
+    between tracks (artist and album names, urls) are interned, so queues and listings of the same music share them.
+    Local files have no id and no url.
+    """
+
+    __slots__ = ("id", "uri", "name", "duration_ms", "artists", "artist_url", "album_name", "image_url")
+
+    def __init__(self, id, uri, name, duration_ms, artists=(), artist_url=None, album_name=None, image_url=None):
+        self.id = id
+        self.uri = uri
+        self.name = name
+        self.duration_ms = duration_ms
+        self.artists = artists  # Names
+        self.artist_url = artist_url  # Of the first artist
+        self.album_name = album_name  # Tracks in album listings have no album info
+        self.image_url = image_url  # Largest album image
+
+    @classmethod
+    def from_dict(cls, track):
+        # Takes a track object of the Spotify API, or the dict of to_dict().
+        artists = track.get("artists") or []  # Podcast episodes have no artists
+        album = track.get("album")
+        images = album.get("images") if album is not None else None
+        return cls(_intern(track["id"]), _intern(track["uri"]), track["name"], track["duration_ms"],
+                   tuple(sys.intern(a["name"]) for a in artists),
+                   _intern(artists[0].get("external_urls", {}).get("spotify")) if artists else None,
+                   _intern(album["name"]) if album is not None else None,
+                   _intern(images[0]["url"]) if images else None)
+
+    @property
+    def url(self):
+        if self.id is None:
+            return None
+        return f"https://open.spotify.com/{self.uri.split(':')[1]}/{self.id}"
+
+    def to_dict(self):
+        # How tracks are stored in the metadata cache table, in the shape of the API's track objects.
+        track = {
+            "id": self.id,
+            "uri": self.uri,
+            "name": self.name,
+            "duration_ms": self.duration_ms,
+            "artists": [{"name": name, "external_urls": {"spotify": self.artist_url if i == 0 else None}}
+                        for i, name in enumerate(self.artists)],
+            "external_urls": {"spotify": self.url},
+        }
+        if self.album_name is not None:
+            track["album"] = {"name": self.album_name, "images": [{"url": self.image_url}] if self.image_url else []}
+        return track
+
+    def __repr__(self):
+        return f"<Track {self.uri} {', '.join(self.artists)} - {self.name}>"
+
@@ -0,0 +1,180 @@
+"""
+UDP transport for the audio of control protocol clients. A client asks for it with "udp": true in HELLO, and gets a
+"udp_token" in WELCOME. It then sends its audio as datagrams to the same port number as the TCP connection, which
+stays open for everything else. Every datagram holds one 20 ms frame: the 8 byte token, a 4 byte (big endian)
+sequence number and FRAME_SIZE bytes of s16le audio.
+
+Frames are put back in order by a small jitter buffer. A frame that is still missing when JITTER_FRAMES later frames
+arrived is concealed: the last frame is repeated while fading out, and the next received frame fades back in.
+"""
+import secrets
+import socket
+import struct
+import sys
+from array import array
+
+FRAME_SIZE = 882 * 4  # 20 ms of 44.1 kHz s16le stereo
+HEADER = struct.Struct("!8sI")
+TOKEN_SIZE = 8
+RECEIVE_BUFFER = 256 * 1024
+
+JITTER_FRAMES = 3  # frames that may arrive before a missing one, before it is concealed
+FLUSH_TIMEOUT = 0.1  # seconds without datagrams after which buffered frames are released anyway
+RESYNC_GAP = 50  # a jump by more frames than this means the client restarted its stream
+FADE = 0.5  # gain per concealed frame in a row, the fade out reaches silence after a few frames
+MAX_CONCEALED = 5  # concealed frames in a row before falling back to silence
+
+
+def ramp(frame, start_gain, end_gain):
+    # Scales a frame by a gain that changes linearly from start_gain to end_gain.
+    samples = array("h", frame)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    frames = len(samples) // 2
+    step = (end_gain - start_gain) / frames
+    for i in range(frames):
+        gain = start_gain + step * i
+        samples[2 * i] = int(samples[2 * i] * gain)
+        samples[2 * i + 1] = int(samples[2 * i + 1] * gain)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+class JitterBuffer:
+    """Puts frames back in order and conceals the ones that were lost."""
+
+    def __init__(self, depth=JITTER_FRAMES):
+        self.depth = depth
+        self.frames = {}  # sequence number -> frame
+        self.next_seq = None
+        self.highest = None
+        self.last_frame = None
+        self.concealed_in_row = 0
+        self.received = self.lost = self.late = self.duplicates = self.reordered = self.resyncs = 0
+
+    def push(self, seq, frame):
+        # Returns the frames that can be played now, in order.
+        if self.next_seq is None or abs(seq - self.next_seq) > RESYNC_GAP:
+            if self.next_seq is not None:
+                self.resyncs += 1
+            self.frames.clear()
+            self.next_seq = self.highest = seq
+        if seq < self.next_seq:
+            self.late += 1
+            return []
+        if seq in self.frames:
+            self.duplicates += 1
+            return []
+        if seq < self.highest:
+            self.reordered += 1
+        self.highest = max(self.highest, seq)
+        self.received += 1
+        self.frames[seq] = frame
+        return self.release(seq - self.depth)
+
+    def flush(self):
+        # No frames arrived for a while, play what is buffered.
+        if len(self.frames) == 0:
+            return []
+        return self.release(max(self.frames))
+
+    def release(self, lost_until):
+        # Frames are played in order, missing frames up to lost_until are concealed.
+        released = []
+        while len(self.frames) > 0:
+            frame = self.frames.pop(self.next_seq, None)
+            if frame is not None:
+                released.append(self.play(frame))
+            elif self.next_seq <= lost_until:
+                released.append(self.conceal())
+            else:
+                break
+            self.next_seq += 1
+        return released
+
+    def play(self, frame):
+        if self.concealed_in_row > 0:
+            # Fade back in from where the concealment left off
+            frame_out = ramp(frame, FADE ** min(self.concealed_in_row, MAX_CONCEALED + 1), 1.0)
+        else:
+            frame_out = frame
+        self.last_frame = frame
+        self.concealed_in_row = 0
+        return frame_out
+
+    def conceal(self):
+        self.lost += 1
+        self.concealed_in_row += 1
+        if self.last_frame is None or self.concealed_in_row > MAX_CONCEALED:
+            return bytes(FRAME_SIZE)
+        return ramp(self.last_frame, FADE ** (self.concealed_in_row - 1), FADE ** self.concealed_in_row)
+
+    def summary(self):
+        return (f"{self.received} frames received, {self.lost} concealed, {self.late} too late, "
+                f"{self.reordered} reordered, {self.duplicates} duplicates, {self.resyncs} resyncs")
+
+
+def open_socket(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        sock.bind(("0.0.0.0", port))
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+class UdpIngest:
+    """Receives the datagrams of one control connection, identified by a new token."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.token = secrets.token_bytes(TOKEN_SIZE)
+        self.jitter = JitterBuffer()
+        self.last_received = None
+        self.rejected = 0
+        self.discard()
+
+    def discard(self):
+        # Datagrams that were waiting in the socket belong to an earlier connection.
+        try:
+            while True:
+                self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def receive(self, now):
+        # Reads all waiting datagrams, returns the frames that can be played now.
+        released = []
+        while True:
+            try:
+                datagram = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            if len(datagram) != HEADER.size + FRAME_SIZE or datagram[:TOKEN_SIZE] != self.token:
+                self.rejected += 1
+                continue
+            _, seq = HEADER.unpack_from(datagram)
+            self.last_received = now
+            released += self.jitter.push(seq, datagram[HEADER.size:])
+        return released
+
+    def is_waiting(self):
+        return len(self.jitter.frames) > 0
+
+    def poll(self, now):
+        # Releases buffered frames once the stream stalled, returns them.
+        if self.is_waiting() and now - self.last_received >= FLUSH_TIMEOUT:
+            return self.jitter.flush()
+        return []
+
+    def summary(self):
+        return f"{self.jitter.summary()}, {self.rejected} rejected"
+
+
+def encode_datagram(token, seq, frame):
+    return HEADER.pack(token, seq) + frame
+
@@ -1,5 +1,11 @@
+import argparse
+import hashlib
 import os
+import re
 import sqlite3
+import time
+
+MIGRATION_FILE_REGEX = re.compile(r"^(?P<version>[0-9]+)_.*\.sql$")
 
 
 def setup_db(conn):
@@ -10,40 +16,118 @@ def setup_db(conn):
     conn.commit()
 
 
-def upgrade_db(conn):
-    c = conn.cursor()
-    db_version = int(c.execute("SELECT value FROM meta WHERE key='db_version';").fetchone()[0])
-    for file in os.listdir("sql"):
-        try:
-            new_version = int(file.split("_")[0])
-            if new_version == 0:
-                continue
-            required_version = new_version - 1
-            if db_version == required_version:
-                print(f"Upgrading db from version {db_version} to {new_version} ({file})...")
-                with open(f"sql/{file}", 'r') as f:
-                    script = f.read()
-                c = conn.cursor()
-                c.executescript(script)
-                conn.commit()
-            elif db_version < required_version:
-                print(f"DB version ({db_version}) too low to upgrade to new version ({new_version}). "
-                      f"Please check migrations and run intermediate migrations first.")
-                return
-            else:
-                print(f"Skipping migration to version {new_version}, db already upgraded (v{db_version}).")
-        except ValueError:
+def get_db_version(conn):
+    return int(conn.execute("SELECT value FROM meta WHERE key='db_version';").fetchone()[0])
+
+
+def get_migrations(path="sql"):
+    # Returns (version, file name) of all migrations, ordered by version number.
+    migrations = []
+    for file in os.listdir(path):
+        m = MIGRATION_FILE_REGEX.match(file)
+        if m is None:
             print(f"File {file} not a valid db migration file.")
+            continue
+        version = int(m.group('version'))
+        if version != 0:
+            migrations.append((version, file))
+    return sorted(migrations)
+
+
+def get_checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def setup_migration_log(conn, migrations, db_version, path="sql"):
+    # Keeps a checksum of every applied migration. Migrations applied before this log existed get the checksum of
+    # their current file.
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version int not null primary key, "
+                 "name varchar(191) not null, checksum varchar(64) not null, applied_at int not null);")
+    for version, file in migrations:
+        if version <= db_version:
+            conn.execute("INSERT OR IGNORE INTO schema_migrations (version, name, checksum, applied_at) "
+                         "VALUES (?, ?, ?, ?);", (version, file, get_checksum(f"{path}/{file}"), int(time.time())))
+    conn.commit()
+
+
+def verify_checksums(conn, migrations, path="sql"):
+    c = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_migrations';")
+    if c.fetchone() is None:
+        return True  # Nothing logged yet
+    applied = dict(conn.execute("SELECT version, checksum FROM schema_migrations;").fetchall())
+    ok = True
+    for version, file in migrations:
+        if version in applied and applied[version] != get_checksum(f"{path}/{file}"):
+            print(f"Migration {file} was changed after it was applied!")
+            ok = False
+    return ok
+
+
+def apply_migration(conn, version, file, path="sql"):
+    with open(f"{path}/{file}", 'r') as f:
+        script = f.read()
+
+    # The migration, the new db_version and the log entry are committed together, or not at all.
+    try:
+        conn.executescript(f"BEGIN;\n{script}\n;")
+        conn.execute("UPDATE meta SET value=? WHERE key='db_version';", (str(version), ))
+        conn.execute("INSERT OR REPLACE INTO schema_migrations (version, name, checksum, applied_at) "
+                     "VALUES (?, ?, ?, ?);", (version, file, get_checksum(f"{path}/{file}"), int(time.time())))
+        conn.commit()
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+
+def upgrade_db(conn, dry_run=False, verify=False, path="sql"):
+    db_version = get_db_version(conn)
+    migrations = get_migrations(path)
+    pending = [(version, file) for version, file in migrations if version > db_version]
+
+    # Fast path for every normal start, don't touch the database or read any migration.
+    if len(pending) == 0 and not verify:
+        return []
+
+    if not dry_run:
+        setup_migration_log(conn, migrations, db_version, path)
+    if verify and verify_checksums(conn, migrations, path):
+        print("All applied migrations match their files.")
+
+    expected_version = db_version + 1
+    for version, file in pending:
+        if version != expected_version:
+            print(f"DB version ({expected_version - 1}) too low to upgrade to new version ({version}). "
+                  f"Please check migrations and run intermediate migrations first.")
+            return []
+        expected_version += 1
+
+    applied = []
+    for version, file in pending:
+        if dry_run:
+            print(f"Would upgrade db from version {version - 1} to {version} ({file}).")
+            continue
+        print(f"Upgrading db from version {version - 1} to {version} ({file})...")
+        apply_migration(conn, version, file, path)
+        applied.append(version)
+    return applied
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="Only show which migrations would be applied.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check that applied migrations weren't changed since they were applied.")
+    args = parser.parse_args()
+
     conn = sqlite3.connect("db.sqlite")
     c = conn.cursor()
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='meta';")
     if not c.fetchone():
         setup_db(conn)
 
-    upgrade_db(conn)
+    upgrade_db(conn, dry_run=args.dry_run, verify=args.verify)
 
     conn.commit()
     conn.close()
@@ -1,6 +1,59 @@
 import json
+import struct
+import threading
+import time
 
-import spotipy
+from log import get_logger
+
+log = get_logger("utils")
+
+
+class StartupTimer:
+    """Records how long each startup phase takes. Phases may run in parallel, in different threads."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = []
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def begin(self, name):
+        self._running[name] = time.perf_counter()
+
+    def end(self, name):
+        start = self._running.pop(name, None)
+        if start is not None:
+            with self._lock:
+                self.phases.append((name, start - self.started_at, time.perf_counter() - start))
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        lines = [f"  {name}: {duration * 1000:.0f} ms (at +{offset * 1000:.0f} ms)"
+                 for name, offset, duration in phases]
+        total = time.perf_counter() - self.started_at
+        return f"Ready in {total * 1000:.0f} ms:\n" + "\n".join(lines)
+
+
+startup_timer = StartupTimer()
+
+
+def get_readable_bytes(fd):
+    # Number of bytes waiting to be read from a pipe or socket.
+    import fcntl
+    import termios
+    return struct.unpack("i", fcntl.ioctl(fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+
+def set_pipe_size(fd, size):
+    # Linux only (and Python 3.10+), elsewhere the pipe keeps its default size.
+    import fcntl
+    if not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except OSError as e:
+        log.warning("Could not resize pipe to %s bytes - %s", size, e)
 
 
 def load_config():
@@ -14,7 +67,14 @@ def save_config(config):
         f.write(json_config)
 
 
+def get_encryption_tool(config):
+    from security import EncryptionTool
+    return EncryptionTool(config['encryption_key_passphrase'].encode("utf-8"),
+                          [k.encode("utf-8") for k in config.get('encryption_old_key_passphrases', [])])
+
+
 def init_spotify(discord_uid):
+    import spotipy
     from spotify_control import SpotifyAuthManger
     config = load_config()
     return spotipy.Spotify(auth_manager=SpotifyAuthManger(
@@ -1,21 +1,39 @@
+import concurrent.futures
 import datetime
-import os
-import sys
-from typing import List
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
-import discord
 import spotipy
-from discord.ext.commands import Bot
 from flask import Flask, abort, request, render_template, redirect
 
-from audio_converter import FFmpegSpotifyAudio
+from bridge import DiscordBridge, get_voice_client, timings
 from db import get_token_info, remove_token, add_or_update_spotify_details, remove_tokens, is_linked_spotify, \
-    get_setting, has_spotify_details
+    get_setting, has_spotify_details, get_session_by_link_code, get_playlist_account_uids
+from log import get_logger
 from spotify_control import SpotifyAuthManger, SpotifyController
 from utils import load_config
 
 
+log = get_logger("webapp")
+
 app = Flask(__name__)
+# Set when running as the coordinator of several worker processes, see main.py
+app.forward_to_workers = False
+
+
+def forward_to_worker(worker_id, path):
+    config = load_config()
+    url = f"http://127.0.0.1:{config['worker_http_port'] + worker_id}{path}?{urllib.parse.urlencode(request.args)}"
+    try:
+        with urllib.request.urlopen(url, timeout=15) as response:
+            return json.loads(response.read())
+    except (urllib.error.URLError, ValueError) as e:
+        log.error("Failed to forward %s to worker %s - %s", path, worker_id, e)
+        return {"status": "error", "error": True, "short_msg": "Bot worker unavailable.",
+                "msg": "The bot process handling this voice session is not reachable. Please try again later."}
 
 
 @app.route('/')
@@ -57,13 +75,22 @@ def link(token):
 
 @app.route('/link_playlist_account', methods=["GET", "POST"])
 def link_playlist():
-    playlist_uid = get_setting('playlist_account_uid')
-    if has_spotify_details(playlist_uid):
+    # Link one of the playlist accounts configured in the 'playlist_account_uids' setting, the first unlinked one
+    # if no uid is given.
+    playlist_uids = get_playlist_account_uids()
+    playlist_uid = request.args.get("uid")
+    if playlist_uid is None:
+        unlinked = [uid for uid in playlist_uids if not has_spotify_details(uid)]
+        if len(unlinked) == 0:
+            return "Already linked"
+        playlist_uid = unlinked[0]
+    elif playlist_uid not in playlist_uids:
+        return "Unknown playlist account"
+    elif has_spotify_details(playlist_uid):
         return "Already linked"
 
     # Redirect to Spotify oAuth login
     config = load_config()
-    print(config['spotify_redirect_uri_playlist'])
     sp = spotipy.Spotify(auth_manager=SpotifyAuthManger(
         discord_uid=playlist_uid,
         client_id=config['spotify_client_id'],
@@ -71,7 +98,7 @@ def link_playlist():
         redirect_uri=config['spotify_redirect_uri_playlist'],
         scope=config['spotify_scopes_playlist']
     ))
-    redirect_url = sp.auth_manager.get_authorize_url(state=1)
+    redirect_url = sp.auth_manager.get_authorize_url(state=playlist_uid)
     return redirect(redirect_url)
 
 
@@ -104,7 +131,7 @@ def callback():
         sp.auth_manager.get_access_token(code=code, check_cache=False)
     except spotipy.SpotifyOauthError as e:
         # Failed
-        print(f"Failed to link - oAuth error - {e}", file=sys.stderr)
+        log.warning("Failed to link - oAuth error - %s", e)
         return render_template('failed.html', **{
             'nick': discord_nick, 'avatar': avatar_url, 'token': str(token)
         })
@@ -124,7 +151,7 @@ def callback():
         })
     except spotipy.SpotifyException as e:
         # Failed
-        print(f"Failed to link - Spotify error - {e}", file=sys.stderr)
+        log.warning("Failed to link - Spotify error - %s", e)
         return render_template('failed.html', **{
             'nick': discord_nick, 'avatar': avatar_url, 'token': str(token)
         })
@@ -133,9 +160,8 @@ def callback():
 @app.route('/callback_playlist/', methods=["GET"])
 def callback_playlist():
     code = request.args.get("code")
-    uid = request.args.get("state")
-    playlist_uid = get_setting('playlist_account_uid')
-    if uid != playlist_uid:
+    playlist_uid = request.args.get("state")
+    if playlist_uid not in get_playlist_account_uids():
         return "Failed to link! Incorrect state."
 
     # Use received authorization code to get refresh token and the likes.
@@ -151,7 +177,7 @@ def callback_playlist():
         sp.auth_manager.get_access_token(code=code, check_cache=False)
     except spotipy.SpotifyOauthError as e:
         # Failed
-        print(f"Failed to link - oAuth error - {e}", file=sys.stderr)
+        log.warning("Failed to link - oAuth error - %s", e)
         return f"Failed to link! oAuth error."
 
     # Test API
@@ -163,7 +189,7 @@ def callback_playlist():
         return "Linked successfully!"
     except spotipy.SpotifyException as e:
         # Failed
-        print(f"Failed to link - Spotify error - {e}", file=sys.stderr)
+        log.warning("Failed to link - Spotify error - %s", e)
         return "Failed to link! Spotify Exception"
 
 
@@ -180,68 +206,134 @@ def connect():
     if controller is not None:
         controller.set_username(request.args.get("user"))
         return {"address": get_setting("stream_host"), "port": controller.port}
+    if app.forward_to_workers:
+        session = get_session_by_link_code(request.args.get("link_code"))
+        if session is not None:
+            return forward_to_worker(session[1], "/connect/")
     config = load_config()
     return {"error": True, "short_msg": "Invalid link code.",
             "msg": f"Invalid link code. Invite the bot to a voice channel first with '{config['prefix']}join'"}
 
 
+async def has_voice_client(client, voice_channel_id):
+    return get_voice_client(client, voice_channel_id) is not None
+
+
+async def start_audio(client, controller):
+    # Runs on the discord event loop. Returns the state of the voice client after trying to play the controller's audio,
+    # "started" if it started a new player. Only bot workers get here, the coordinator doesn't import discord.
+    import discord
+    from broadcast import play_broadcast
+
+    voice_client = get_voice_client(client, controller.voice_channel_id)
+    if voice_client is None:
+        return "no session"
+
+    # If it is playing from the source of this link code, allow the client to reconnect and continue playing where it
+    # left off.
+    if voice_client.is_playing():
+        if is_playing_controller(voice_client, controller):
+            return "playing"
+        return "busy"
+
+    # If the bot is not playing, initialize a new source and start playing.
+    try:
+        play_broadcast(voice_client, controller.open_audio_source())
+    except discord.ClientException:
+        return "busy"
+    return "started"
+
+
+async def stop_audio(client, controller):
+    # Runs on the discord event loop. Stops the voice client if it plays the controller's audio.
+    voice_client = get_voice_client(client, controller.voice_channel_id)
+    if voice_client is not None and is_playing_controller(voice_client, controller):
+        voice_client.stop()
+
+
+def is_playing_controller(voice_client, controller):
+    return controller.broadcast is not None and getattr(voice_client.source, "broadcast", None) is controller.broadcast
+
+
+def stop_started_audio(bridge, controller, audio):
+    # When switching Spotify failed, the audio that start_session started has nothing to play. start_audio doesn't
+    # wait for anything, so waiting for it to finish is quick.
+    try:
+        if audio.result(bridge.timeout) == "started":
+            bridge.submit(stop_audio(bridge.client, controller)).result(bridge.timeout)
+    except concurrent.futures.TimeoutError:
+        audio.cancel()
+        controller.log.warning("Bot did not respond while stopping the audio of a failed start")
+
+
+def start_session(controller):
+    # Switches Spotify to the bot player and starts playing the session's audio. Used by /start/ and by clients
+    # that start their session over the control protocol.
+    started = time.perf_counter()
+    # noinspection PyUnresolvedReferences
+    bridge: DiscordBridge = app.bridge
+
+    # Only switch the user's Spotify to the bot player when the bot is in the voice channel to play it.
+    try:
+        in_channel = bridge.submit(has_voice_client(bridge.client, controller.voice_channel_id)).result(bridge.timeout)
+        state = None if in_channel else "no session"
+    except concurrent.futures.TimeoutError:
+        state = "timeout"
+
+    if state is None:
+        # Start the audio on the event loop while this thread switches Spotify to the bot player. The audio source
+        # just waits for the client's stream, so it doesn't matter which one is done first.
+        audio = bridge.submit(start_audio(bridge.client, controller))
+        try:
+            with timings.measure("/start/ switch device"):
+                controller.clear_current_track()
+                controller.start_playback()
+        except IndexError:
+            stop_started_audio(bridge, controller, audio)
+            controller.log.warning("Spoofy playback device not found in Spotify. Is the client app running?")
+            return {"status": "error", "error": True, "short_msg": "Device not found.",
+                    "msg": "Spoofy playback device not found in Spotify. Is the client app running?"}
+        except spotipy.SpotifyException as e:
+            # Failed
+            stop_started_audio(bridge, controller, audio)
+            controller.log.error("Failed to connect to spotify API! %s", e)
+            return {"status": "error", "error": True, "short_msg": "Could not switch players.",
+                    "msg": "Failed to connect to Spotify API to switch players!"}
+
+        try:
+            state = audio.result(bridge.timeout)
+        except concurrent.futures.TimeoutError:
+            audio.cancel()
+            state = "timeout"
+    timings.record("/start/", time.perf_counter() - started)
+
+    if state in ("started", "playing"):
+        return {"status": "OK"}
+    if state == "busy":
+        # This is too complex of a situation to bother to fix. Disconnect the client.
+        return {"status": "error", "error": True, "short_msg": "Already playing audio.",
+                "msg": "Failed to start playback, bot is already playing audio from a different source! "
+                       "If this is incorrect, reconnect the bot (s!leave, and then s!join)."}
+    if state == "timeout":
+        return {"status": "error", "error": True, "short_msg": "Bot not responding.",
+                "msg": "The bot did not start playing in time, please try again."}
+
+    config = load_config()
+    return {"error": True, "short_msg": "No active voice session",
+            "msg": f"Could not find an active voice session. "
+                   f"Invite the bot to a voice channel first with '{config['prefix']}join'"}
+
+
 @app.route('/start/', methods=["GET"])
 def start():
     link_code = request.args.get("link_code")
     controller = SpotifyController.get_instance_by_link_code(link_code)
     if controller is not None:
-        # noinspection PyUnresolvedReferences
-        bot: Bot = app.discord_bot
-        voice_controller: List[discord.VoiceClient] = [x for x in bot.voice_clients
-                                                       if x.channel.id == controller.voice_channel_id]
-        voice_controller: discord.VoiceClient = voice_controller[0] if len(voice_controller) > 0 else None
-        if voice_controller is not None:
-            # Switch Spotify to the bot player
-            try:
-                controller.clear_current_track()
-                controller.start_playback()
-            except IndexError:
-                print("Spoofy playback device not found in Spotify. Is the client app running?")
-                return {"status": "error", "error": True, "short_msg": "Device not found.",
-                        "msg": "Spoofy playback device not found in Spotify. Is the client app running?"}
-            except spotipy.SpotifyException as e:
-                # Failed
-                print(f"Failed to connect to spotify API! {e}")
-                return {"status": "error", "error": True, "short_msg": "Could not switch players.",
-                        "msg": "Failed to connect to Spotify API to switch players!"}
-
-            # Start playing audio from the controller
-            try:
-                # If the bot is not playing, initialize a new source and start playing.
-                if not voice_controller.is_playing():
-                    source = discord.PCMVolumeTransformer(FFmpegSpotifyAudio(
-                        os.fdopen(controller.socket_io_r, 'rb', buffering=0),
-                        link_code=link_code,
-                        pipe=True
-                    ))
-                    voice_controller.play(source, after=lambda x: print('Player error: %s' % x) if x else None)
-                    return {"status": "OK"}
-
-                # If it is playing, and it is playing from the same FFmpegSpotifyAudio source with this link code,
-                # allow the client to reconnect and continue playing where it left off.
-                elif isinstance(voice_controller.source, discord.PCMVolumeTransformer):
-                    if isinstance(voice_controller.source.original, FFmpegSpotifyAudio):
-                        if voice_controller.source.original.link_code == link_code:
-                            return {"status": "OK"}
-
-                # In any other case, this is too complex of a situation to bother to fix. Disconnect the client.
-                return {"status": "error", "error": True, "short_msg": "Already playing audio.",
-                        "msg": "Failed to start playback, bot is already playing audio from a different source! "
-                               "If this is incorrect, reconnect the bot (s!leave, and then s!join)."}
-            except discord.ClientException:
-                return {"status": "error", "error": True, "short_msg": "Already playing audio.",
-                        "msg": "Failed to start playback, bot is already playing audio from a different source! "
-                               "If this is incorrect, reconnect the bot (s!leave, and then s!join)."}
-
-        config = load_config()
-        return {"error": True, "short_msg": "No active voice session",
-                "msg": f"Could not find an active voice session. "
-                       f"Invite the bot to a voice channel first with '{config['prefix']}join'"}
+        return start_session(controller)
+    if app.forward_to_workers:
+        session = get_session_by_link_code(link_code)
+        if session is not None:
+            return forward_to_worker(session[1], "/start/")
     config = load_config()
     return {"error": True, "short_msg": "Invalid link code.",
             "msg": f"Invalid link code. Invite the bot to a voice channel first with '{config['prefix']}join'"}